@@ -0,0 +1,199 @@
+#!/usr/bin/python
+import argparse, json, logging, os, socket, subprocess, sys, tempfile, threading, time
+import ConfigContainer
+
+# What the ffmpeg on this host can really do. ffmpeg lists the encoders, decoders and hardware accelerations it was
+# built with, but a build with nvenc in it says nothing about whether there is a GPU and driver to run it on, so each
+# hardware path also has to get through a second of synthetic video before we trust it. Results are kept in a JSON
+# file so this happens once per host (and ffmpeg binary) rather than once per process, and redone after a while in
+# case the drivers changed.
+
+# Test pattern the validation encodes run on, small enough to be quick but over the minimum frame size of NVENC
+VALIDATION_SOURCE = ['-f', 'lavfi', '-i', 'testsrc2=size=320x240:rate=25:duration=1']
+
+# Give up on a validation run that hangs, a wedged driver can do that
+VALIDATION_TIMEOUT = 60
+
+# A path that failed its check may only have been busy, NVENC runs out of sessions while our own encodes hold them, so
+# try it again after this many seconds rather than going without it for the whole TTL
+FAILED_RECHECK = 600
+
+# Software encoders to make a sample in for each hardware decoder to decode, where ffmpeg has one
+DECODER_SAMPLES = {
+    'h264_cuvid' : 'libx264',
+    'hevc_cuvid' : 'libx265',
+    'mjpeg_cuvid' : 'mjpeg',
+    'mpeg1_cuvid' : 'mpeg1video',
+    'mpeg2_cuvid' : 'mpeg2video',
+    'mpeg4_cuvid' : 'mpeg4',
+    'vp8_cuvid' : 'libvpx',
+    'vp9_cuvid' : 'libvpx-vp9'
+}
+
+def ParseCodecList(output):
+    # -encoders and -decoders print a legend, a line of dashes, then one "flags name description" line per codec
+    names = []
+    listing = False
+    for line in output.splitlines():
+        if line.strip().startswith('------'):
+            listing = True
+        elif listing and len(line.split()) >= 2:
+            names.append(line.split()[1])
+    return names
+
+def ParseHWAccels(output):
+    # A heading, then one method per line
+    return [line.strip() for line in output.splitlines()[1:] if line.strip()]
+
+class Capabilities(object):
+    def __init__(self, ffmpeg_path, cache_path, ttl):
+        self.ffmpeg_path = ffmpeg_path
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        self.data = self.load()
+
+    def key(self):
+        # A new ffmpeg may well be built with different codecs
+        try:
+            st = os.stat(self.ffmpeg_path)
+            return '{}:{}:{}:{}'.format(socket.gethostname(), os.path.realpath(self.ffmpeg_path), st.st_size, int(st.st_mtime))
+        except OSError:
+            return '{}:{}'.format(socket.gethostname(), self.ffmpeg_path)
+
+    def load(self):
+        try:
+            with open(self.cache_path, 'r') as f:
+                data = json.load(f)
+            if data.get('key') == self.key() and time.time() - data.get('probed', 0) < self.ttl:
+                return data
+        except (IOError, ValueError):
+            pass
+        return self.probe()
+
+    def probe(self):
+        logging.info('[Capabilities] Probing what {} can do'.format(self.ffmpeg_path))
+        data = {'key' : self.key(), 'probed' : time.time(), 'validated' : {}}
+        for name, option, parse in [('encoders', '-encoders', ParseCodecList), ('decoders', '-decoders', ParseCodecList),
+                                    ('hwaccels', '-hwaccels', ParseHWAccels)]:
+            returncode, output = self.run([option])
+            data[name] = parse(output) if returncode == 0 else []
+        logging.info('[Capabilities] {} encoders, {} decoders, hardware acceleration: {}'.format(
+            len(data['encoders']), len(data['decoders']), ', '.join(data['hwaccels']) or 'none'))
+        self.save(data)
+        return data
+
+    def save(self, data):
+        # Write it whole and rename it into place, other processes may be reading it
+        try:
+            handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.cache_path)), suffix='.tmp')
+            with os.fdopen(handle, 'w') as f:
+                json.dump(data, f)
+            os.rename(temp_path, self.cache_path)
+        except (IOError, OSError), e:
+            logging.info('[Capabilities] Could not save the probe results, they will be redone next time: {}'.format(e))
+
+    def run(self, args):
+        try:
+            process = subprocess.Popen([self.ffmpeg_path, '-hide_banner'] + args, stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT)
+        except OSError, e:
+            return None, str(e)
+        timer = threading.Timer(VALIDATION_TIMEOUT, process.kill)
+        timer.start()
+        try:
+            output = process.communicate()[0]
+        finally:
+            timer.cancel()
+        return process.returncode, output
+
+    def refresh(self):
+        # We live as long as the process does, and a daemon or a watch can run for longer than the TTL, or across an
+        # ffmpeg or driver upgrade
+        with self.lock:
+            if time.time() - self.data['probed'] >= self.ttl or self.data['key'] != self.key():
+                self.data = self.load()
+
+    def checked(self, path):
+        # The result of an earlier check we can still go by, or None
+        result = self.data['validated'].get(path)
+        if not isinstance(result, dict):
+            return None
+        if time.time() - result['checked'] < (self.ttl if result['works'] else FAILED_RECHECK):
+            return result['works']
+        return None
+
+    def validate(self, path, args):
+        with self.lock:
+            works = self.checked(path)
+            if works is None:
+                returncode, output = self.run(args)
+                works = returncode == 0
+                self.data['validated'][path] = {'works' : works, 'checked' : time.time()}
+                if works:
+                    logging.info('[Capabilities] {} works'.format(path))
+                else:
+                    tail = output.strip().splitlines()[-1:] if output else []
+                    logging.info('[Capabilities] {} does not work here: {}'.format(path, tail[0] if tail else returncode))
+                self.save(self.data)
+            return works
+
+    def encoder(self, name):
+        self.refresh()
+        if name not in self.data['encoders']:
+            return False
+        return self.validate('encode:' + name, ['-y'] + VALIDATION_SOURCE + ['-c:v', name, '-f', 'null', '-'])
+
+    def decoder(self, name):
+        self.refresh()
+        if name not in self.data['decoders']:
+            return False
+        sample = DECODER_SAMPLES.get(name)
+        if sample is None or sample not in self.data['encoders']:
+            # Nothing to make a sample with, so all we can go on is that it is built in
+            return True
+
+        # Hold the lock throughout, so two threads checking the same decoder don't both go making samples
+        with self.lock:
+            works = self.checked('decode:' + name)
+            if works is not None:
+                return works
+
+            handle, sample_path = tempfile.mkstemp(prefix='capabilities-{}-'.format(name), suffix='.mkv')
+            os.close(handle)
+            try:
+                # The sample is made in software, so if that fails it tells us nothing about the decoder
+                if self.run(['-y'] + VALIDATION_SOURCE + ['-c:v', sample, sample_path])[0] != 0:
+                    logging.info('[Capabilities] Could not make a sample to check {} with'.format(name))
+                    return True
+                return self.validate('decode:' + name, ['-y', '-hwaccel', 'cuvid', '-c:v', name, '-i', sample_path, '-f', 'null', '-'])
+            finally:
+                os.remove(sample_path)
+
+_capabilities = {}
+_capabilities_lock = threading.Lock()
+
+def GetCapabilities(config):
+    with _capabilities_lock:
+        if config.FFMPEG_PATH not in _capabilities:
+            _capabilities[config.FFMPEG_PATH] = Capabilities(config.FFMPEG_PATH, config.CAPABILITIES_PATH, config.CAPABILITIES_TTL)
+        return _capabilities[config.FFMPEG_PATH]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--refresh", action='store_true', help="Probe again now, rather than using what was found before")
+    args = parser.parse_args()
+
+    config_file_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'scripts.conf')
+    config = ConfigContainer.ConfigContainer(config_file_path)
+    if args.refresh and os.path.exists(config.CAPABILITIES_PATH):
+        os.remove(config.CAPABILITIES_PATH)
+
+    capabilities = GetCapabilities(config)
+    print('Hardware acceleration: {}'.format(', '.join(capabilities.data['hwaccels']) or 'none'))
+    for name in ['hevc_nvenc', 'h264_nvenc']:
+        print('Encoder {}: {}'.format(name, 'works' if capabilities.encoder(name) else 'not available'))
+    for name in sorted(DECODER_SAMPLES):
+        print('Decoder {}: {}'.format(name, 'works' if capabilities.decoder(name) else 'not available'))
+    sys.exit(0)
@@ -0,0 +1,131 @@
+#!/usr/bin/python
+import argparse, os, sys
+import Scanner, Comskip, Transcoder, Renamer
+
+STAGES = ['comskip', 'transcode', 'rename']
+
+class CombinedScanner(Scanner.MediaScanner):
+    def __init__(self, codec, crf, speed, interactive, probe_workers=1, skip=None):
+        # Call the super constructor, we evaluate the stage rules ourselves
+        super(CombinedScanner, self).__init__([], self.combined_action, interactive, probe_workers)
+
+        # Build the stages in the order their actions need to run: cut commercials out of the raw recording first,
+        # then transcode it, then fix up any extensions that are still wrong
+        skip = skip or []
+        self.stages = []
+        scanners = []
+        if 'comskip' not in skip:
+            comskip = Comskip.ComskipScanner(False)
+            scanners.append(comskip)
+            self.stages.append(('comskip', comskip.mpeg2_rule, comskip.comskip_action, comskip.job_resource()))
+        if 'transcode' not in skip:
+            transcoder = Transcoder.TranscodeScanner(codec, crf, speed, False)
+            scanners.append(transcoder)
+            self.stages.append(('transcode', transcoder.mpeg2_rule, transcoder.transcode_action, transcoder.job_resource()))
+        if 'rename' not in skip:
+            renamer = Renamer.RenameScanner(False)
+            scanners.append(renamer)
+            self.stages.append(('rename', renamer.matroska_rule, renamer.rename_action, renamer.job_resource()))
+
+        # The stage actions run on our threads under the lease we took, so they have to see our per thread state to
+        # notice when it has been lost
+        for scanner in scanners:
+            scanner.local = self.local
+
+        # Only used to decide whether a header sniff is enough to settle every stage
+        self.rules = [rule for name, rule, action, resource in self.stages]
+
+    def matching_stages(self, full_path, mediainfo):
+        # Every stage is judged against the one probe of this file
+        matched = []
+        for name, rule, action, resource in self.stages:
+            try:
+                if rule(mediainfo):
+                    matched.append(name)
+            except Exception as err:
+                print("Caught exception when running the {} rule on {}, exception: {}".format(name, full_path, err))
+        return matched
+
+    def match_rules(self, full_path, mediainfo):
+        if mediainfo is None:
+            return None
+
+        matched = self.matching_stages(full_path, mediainfo)
+        if len(matched) == 0:
+            return None
+
+        print("Matched {} rules for file {}".format(", ".join(matched), full_path))
+        if self.interactive:
+            skip = raw_input('Do you want to process {} [Y/N]'.format(full_path))
+            if(len(skip) == 0 or skip[0].lower() == 'n'):
+                return None
+
+        return mediainfo, matched
+
+    def recheck(self, full_path, match):
+        if not os.path.exists(full_path):
+            return None
+
+        mediainfo = self.probe_file(full_path)
+        if mediainfo is None:
+            return None
+        matched = self.matching_stages(full_path, mediainfo)
+        return (mediainfo, matched) if matched else None
+
+    def job_stages(self):
+        # Each stage is its own job, so each runs in its own resource slots; the queue still runs them in order
+        return [(name, resource, [rule], action) for name, rule, action, resource in self.stages]
+
+    def queued_stages(self, match):
+        return match[1]
+
+    def combined_action(self, path, match):
+        mediainfo, matched = match
+
+        first = True
+        for name, rule, action, resource in self.stages:
+            if name not in matched:
+                continue
+
+            if not first:
+                path = self.current_path(path)
+                if not os.path.exists(path):
+                    print("{} is gone after the previous stage, skipping the {} stage".format(path, name))
+                    return 1
+
+                # An earlier stage may have rewritten the file. The probe cache only re-parses it if it actually
+                # changed, and then the rule gets another look at what is there now.
+                mediainfo = self.probe_cache.parse(path)
+                if not rule(mediainfo):
+                    print("{} no longer needs the {} stage".format(path, name))
+                    continue
+
+            print('Running the {} stage on {}'.format(name, path))
+            status = action(path, mediainfo)
+            if status:
+                print("The {} stage failed on {}, skipping the rest".format(name, path))
+                return status
+            first = False
+
+        return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', action="append", default=[], help='"One or more directories to scan.')
+    parser.add_argument("--interactive", action='store_true', help="Be prompted for each file that we want to process")
+    parser.add_argument("--watch", action='store_true', help="After the first scan, keep watching the input directories and process new recordings as they settle")
+    parser.add_argument("--skip", action="append", default=[], choices=STAGES, help="Stages to leave out of this scan")
+    parser.add_argument("--codec", default='auto', choices=['auto', 'x265', 'hevc_nvenc', 'x264', 'h264_nvenc', 'vp9', 'none'], help="What codec to use for the encoding")
+    parser.add_argument("--crf", default='23', choices=map(str, range(0, 51)), help="What quality to use when for encoded (lower is higher quality and bigger files)")
+    parser.add_argument("--speed", default='medium', choices=['ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium', 'slow', 'slower', 'veryslow', 'placebo', 'hq'], help="Encoding speed (faster encoding is results in a less efficient representation)")
+    parser.add_argument("--probe-workers", type=int, default=1, help="Number of files to probe with MediaInfo concurrently")
+    args = parser.parse_args()
+
+    scanner = CombinedScanner(args.codec, args.crf, args.speed, args.interactive, args.probe_workers, args.skip)
+    if args.watch:
+        scanner.watch(args.input)
+    else:
+        scanner.scan(args.input)
+
+    sys.exit(0)
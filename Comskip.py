@@ -1,9 +1,17 @@
 #!/usr/bin/python
 
-import logging, os, shutil, subprocess, sys, tempfile, glob, time, uuid, argparse
+import logging, os, shutil, subprocess, sys, tempfile, glob, time, uuid, argparse, bisect
 import ConfigContainer, Scanner, MediaProcessor
 
+# Keyframe timestamps within this many seconds of a cut point count as being on it
+KEYFRAME_EPSILON = 0.001
+
+# About as long as a broadcast GOP. A last keep segment that starts closer than this to the end of the file is only the
+# tail of the final commercial, as the concat demuxer starts it from the keyframe before its in point.
+TAIL_SLACK = 1.0
+
 class Comskip(MediaProcessor.MediaProcessor):
+    @MediaProcessor.metered('comskip')
     @MediaProcessor.exception_logger
     def GenerateSegments(self, input_file):
         video_path = input_file
@@ -54,26 +62,161 @@ class Comskip(MediaProcessor.MediaProcessor):
 
     @MediaProcessor.exception_logger
     def ProcessSegments(self, input_file, segments):
+        if self.config.CUT_MODE == 'segments':
+            return self.ProcessSegmentFiles(input_file, segments)
+        elif self.config.CUT_MODE == 'smartcut':
+            return self.SmartCut(input_file, segments)
+        return self.ConcatCut(input_file, segments)
+
+    @MediaProcessor.exception_logger
+    def WriteConcatList(self, list_path, entries):
+        # Entries are (file, inpoint, outpoint), with None for an open end
+        with open(list_path, 'w+') as segment_list_file:
+            for path, inpoint, outpoint in entries:
+                segment_list_file.write("file '{}'\n".format(path.replace("'", "'\\''")))
+                if inpoint is not None:
+                    segment_list_file.write('inpoint {:.6f}\n'.format(inpoint))
+                if outpoint is not None:
+                    segment_list_file.write('outpoint {:.6f}\n'.format(outpoint))
+
+    @MediaProcessor.exception_logger
+    def CutOutputPath(self, input_file):
+        # The input may be a copy of the original in the temp dir already, and ffmpeg would truncate it while the
+        # concat demuxer is still reading from it
+        name, ext = os.path.splitext(os.path.basename(input_file))
+        output_path = os.path.join(self.temp_dir, name + '-cut' + ext)
+        if os.path.abspath(output_path) == os.path.abspath(input_file):
+            raise Exception("Cutting {} would overwrite it while it is being read".format(input_file))
+        return output_path
+
+    @MediaProcessor.metered('cut')
+    @MediaProcessor.exception_logger
+    def ConcatCut(self, input_file, segments):
+        segment_list_file_path = os.path.join(self.temp_dir, 'segments.txt')
+        output_path = self.CutOutputPath(input_file)
+
+        # The concat demuxer's in and out points are in the file's own timestamps, while the EDL counts from zero
+        start_time = self.StartTime(input_file)
+        duration = self.MediaDuration(input_file)
+
+        # Point the concat demuxer at the original once per keep segment and let it seek to each in/out point, so the
+        # whole cut is a single pass over the input with no per-segment files
+        entries = []
+        for i, (start, end) in enumerate(segments):
+            if end == -1 and duration is not None:
+                if duration - start < TAIL_SLACK:
+                    logging.info('Segment %s starts at the very end of the file, leaving it out.' % i)
+                    continue
+                # Give it an out point like the others have
+                end = duration
+            if end != -1 and end <= start:
+                logging.info('Segment %s is empty, leaving it out.' % i)
+                continue
+            entries.append((input_file, start_time + start, None if end == -1 else start_time + end))
+        self.WriteConcatList(segment_list_file_path, entries)
+
+        logging.info('Cutting {} segments out of {} in one pass.'.format(len(entries), input_file))
+
+        cmd = [self.config.FFMPEG_PATH, '-y', '-f', 'concat', '-safe', '0', '-i', segment_list_file_path, '-c', 'copy'] + \
+              self.MatroskaArgs(output_path, duration) + [output_path]
+        self.Call(cmd)
+        return output_path
+
+    @MediaProcessor.exception_logger
+    def SmartCutEncodeArgs(self, mediainfo):
+        # How to re-encode the partial GOPs so they can sit next to stream-copied video from the original. Only MPEG-2
+        # carries its sequence headers in the stream; AVC and HEVC pieces from our encoder would come with parameter sets
+        # that don't match the copied GOPs, and the joined file wouldn't decode across the cuts.
+        video = [track for track in mediainfo.tracks if track.track_type == 'Video']
+        if len(video) == 0 or video[0].format != 'MPEG Video':
+            return None
+
+        args = ['-c:v:0', 'mpeg2video', '-q:v', '2']
+        if video[0].scan_type is not None and video[0].scan_type != 'Progressive':
+            args.extend(['-flags', '+ilme+ildct'])
+        return args
+
+    @MediaProcessor.exception_logger
+    def EncodePiece(self, input_file, name, start, end, encode_args):
+        piece_path = os.path.join(self.temp_dir, name + os.path.splitext(input_file)[1])
+
+        # Seek on the input so we only decode from the GOP before the start, then cut frame-accurately
+        duration_args = [] if end == -1 else ['-t', '{:.6f}'.format(end - start)]
+        cmd = [self.config.FFMPEG_PATH, '-y', '-ss', '{:.6f}'.format(start), '-i', input_file] + duration_args + \
+              ['-map', '0', '-ignore_unknown', '-c', 'copy'] + encode_args + [piece_path]
+        self.Call(cmd)
+        return piece_path
+
+    @MediaProcessor.metered('cut')
+    @MediaProcessor.exception_logger
+    def SmartCut(self, input_file, segments):
+        encode_args = self.SmartCutEncodeArgs(self.probe_cache.parse(input_file))
+        if encode_args is None:
+            logging.info('Don\'t know how to re-encode the video in {}, falling back to a plain concat cut'.format(input_file))
+            return self.ConcatCut(input_file, segments)
+
+        keyframes = self.KeyframeIndex(input_file)
+        start_time = self.StartTime(input_file)
+        segment_list_file_path = os.path.join(self.temp_dir, 'segments.txt')
+        output_path = self.CutOutputPath(input_file)
+
+        # Re-encode from each cut point up to the first keyframe inside the segment, and stream-copy everything from
+        # that keyframe to the end of the segment straight out of the original
+        entries = []
+        for i, (start, end) in enumerate(segments):
+            if end != -1 and end <= start:
+                logging.info('Segment %s is empty, leaving it out.' % i)
+                continue
+
+            first = bisect.bisect_left(keyframes, start - KEYFRAME_EPSILON)
+            head_end = keyframes[first] if first < len(keyframes) else None
+
+            if head_end is None or (end != -1 and head_end >= end - KEYFRAME_EPSILON):
+                logging.info('Segment %s has no keyframe in it, re-encoding all of it.' % i)
+                entries.append((self.EncodePiece(input_file, 'segment-%s-all' % i, start, end, encode_args), None, None))
+                continue
+
+            if head_end - start > KEYFRAME_EPSILON:
+                entries.append((self.EncodePiece(input_file, 'segment-%s-head' % i, start, head_end, encode_args), None, None))
+            entries.append((input_file, start_time + head_end, None if end == -1 else start_time + end))
+
+        self.WriteConcatList(segment_list_file_path, entries)
+        logging.info('Smart cutting {} segments out of {}.'.format(len(segments), input_file))
+
+        cmd = [self.config.FFMPEG_PATH, '-y', '-f', 'concat', '-safe', '0', '-i', segment_list_file_path, '-c', 'copy'] + \
+              self.MatroskaArgs(output_path, self.MediaDuration(input_file)) + [output_path]
+        self.Call(cmd)
+        return output_path
+
+    @MediaProcessor.metered('cut')
+    @MediaProcessor.exception_logger
+    def ProcessSegmentFiles(self, input_file, segments):
         segment_files = []
         segment_list_file_path = os.path.join(self.temp_dir, 'segments.txt')
         video_basename = os.path.basename(input_file)
         video_name, video_ext = os.path.splitext(video_basename)
         output_path = os.path.join(self.temp_dir, video_basename)
 
+        # Seek on the input to the keyframe at or before each segment, rather than reading from the top of the file
+        keyframes = self.KeyframeIndex(input_file)
+
         with open(segment_list_file_path, 'w+') as segment_list_file:
             for i, segment in enumerate(segments):
                 segment_name = 'segment-%s' % i
                 segment_file_name = '%s%s' % (segment_name, video_ext)
                 segment_path = os.path.join(self.temp_dir, segment_file_name)
 
+                keyframe = bisect.bisect_right(keyframes, segment[0] + KEYFRAME_EPSILON) - 1
+                seek = keyframes[keyframe] if keyframe >= 0 else 0.0
+
                 # Check duration of segment
                 if segment[1] == -1:
                     duration_args = []
                 else:
-                    duration_args = ['-t', str(segment[1] - segment[0])]
+                    duration_args = ['-t', str(segment[1] - seek)]
 
                 # Use FFMPEG to generate a new file containing only this segment
-                cmd = [self.config.FFMPEG_PATH, '-i', input_file, '-ss', str(segment[0])] + duration_args + ['-c', 'copy', segment_path]
+                cmd = [self.config.FFMPEG_PATH, '-ss', str(seek), '-i', input_file] + duration_args + ['-c', 'copy', segment_path]
                 self.Call(cmd)
 
                 # If the last drop segment ended at the end of the file, we will have written a zero-duration file.
@@ -88,32 +231,50 @@ class Comskip(MediaProcessor.MediaProcessor):
         logging.info('Going to concatenate files from the segment list.')
 
         # Build concatenation part of the command
-        cmd = [self.config.FFMPEG_PATH, '-y', '-f', 'concat', '-safe', '0', '-i', segment_list_file_path, '-c', 'copy', output_path]
+        cmd = [self.config.FFMPEG_PATH, '-y', '-f', 'concat', '-safe', '0', '-i', segment_list_file_path, '-c', 'copy'] + \
+              self.MatroskaArgs(output_path, self.MediaDuration(input_file)) + [output_path]
         self.Call(cmd)
         return output_path
 
 class ComskipScanner(Scanner.MediaScanner):
-    def __init__(self, interactive):
+    JOB_NAME = 'comskip'
+    JOB_RESOURCE = 'comskip'
+
+    def __init__(self, interactive, probe_workers=1):
         # Call the super constructor
-        super(ComskipScanner, self).__init__([self.mpeg2_rule], self.comskip_action, interactive)
+        super(ComskipScanner, self).__init__([self.mpeg2_rule], self.comskip_action, interactive, probe_workers)
 
         # Process the configuration file
-        config_file_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'scripts.conf')
+        self.config_file_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'scripts.conf')
 
-        # Create PlexComskip Object
-        self.comskip = Comskip(config_file_path)
+    @property
+    def comskip(self):
+        # Create PlexComskip Object, one per thread so job queue workers each get their own temp dir
+        if not hasattr(self.local, 'comskip'):
+            self.local.comskip = Comskip(self.config_file_path)
+        return self.local.comskip
 
     def comskip_action(self, path, mediainfo):
-        # Get the segments that are commerical free
-        intermediate_path, segments = self.comskip.GenerateSegments(path)
+        try:
+            # Get the segments that are commerical free
+            intermediate_path, segments = self.comskip.GenerateSegments(path)
 
-        # Cut the commercials out of the original file
-        processed_file = self.comskip.ProcessSegments(intermediate_path, segments)
+            # Cut the commercials out of the original file
+            processed_file = self.comskip.ProcessSegments(intermediate_path, segments)
+            if self.lease_lost():
+                self.comskip.Error('Lost our claim on {} while cutting it, leaving it to the other host...'.format(path))
+                self.comskip.Cleanup()
+                return 1
 
-        # Check that file looks sane and then copy it over
-        if self.comskip.SafeOverwrite(path, processed_file, .1, 1.0) == 0:
-            # Clean up temporary files
+            # Check that file looks sane and then copy it over
+            if self.comskip.SafeOverwrite(path, processed_file, .1, 1.0) == 0:
+                # Clean up temporary files
+                self.comskip.Cleanup()
+                return 0
+        except Exception, e:
+            self.comskip.Error('Could not comskip {}, cleaning up temp files and skipping...'.format(path))
             self.comskip.Cleanup()
+        return 1
 
     def mpeg2_rule(self, mediainfo):
         for track in mediainfo.tracks:
@@ -128,9 +289,14 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--input', action="append", default=[], help='"One or more directories to scan.')
     parser.add_argument("--interactive", action='store_true', help="Be prompted for each file that we want to comskip")
+    parser.add_argument("--watch", action='store_true', help="After the first scan, keep watching the input directories and process new recordings as they settle")
+    parser.add_argument("--probe-workers", type=int, default=1, help="Number of files to probe with MediaInfo concurrently")
     args = parser.parse_args()
 
-    comskip = ComskipScanner(args.interactive)
-    comskip.scan(args.input)
+    comskip = ComskipScanner(args.interactive, args.probe_workers)
+    if args.watch:
+        comskip.watch(args.input)
+    else:
+        comskip.scan(args.input)
 
     sys.exit(0)
@@ -8,18 +8,78 @@ class ConfigContainer(object):
             print('Make sure scripts.conf is placed in the same directory as this script.')
             raise IOError("File does not exist: {}".format(path))
 
-        config = ConfigParser.SafeConfigParser({'comskip-ini-path' : os.path.join(os.path.dirname(os.path.realpath(__file__)), 'comskip.ini'), 'temp-root' : tempfile.gettempdir()})
+        config = ConfigParser.SafeConfigParser({'comskip-ini-path' : os.path.join(os.path.dirname(os.path.realpath(__file__)), 'comskip.ini'), 'temp-root' : tempfile.gettempdir(),
+                                             'probe-cache' : 'True', 'probe-cache-path' : '', 'cut-mode' : 'concat',
+                                             'ffprobe-path' : '', 'mkclean-remux' : 'False', 'capabilities-path' : '', 'capabilities-ttl' : '604800',
+                                             'chunk-workers' : '0', 'chunk-length' : '120',
+                                             'leases' : 'False', 'lease-dir' : '', 'lease-ttl' : '600',
+                                             'job-queue' : 'False', 'job-queue-path' : '', 'sw-encode-slots' : '1',
+                                             'hw-encode-slots' : '2', 'comskip-slots' : '1', 'remux-slots' : '1',
+                                             'job-retries' : '3', 'job-retry-backoff' : '60', 'job-lease' : '300',
+                                             'early-abort' : 'True', 'early-abort-interval' : '30', 'early-abort-window' : '3',
+                                             'early-abort-min-progress' : '0.05', 'live-idle-timeout' : '120', 'metrics-path' : '', 'log-format' : 'text',
+                                             'socket-path' : '', 'max-pipelines' : '4',
+                                             'watch-settle' : '30', 'watch-poll-interval' : '60'})
         config.read(path)
 
+        # Sections added after the fact may be missing from older config files, fall back to the defaults for them
+        for section in ['Comskip', 'Job Queue', 'Daemon']:
+            if not config.has_section(section):
+                config.add_section(section)
+
         self.COMSKIP_PATH = os.path.expandvars(os.path.expanduser(config.get('Helper Apps', 'comskip-path')))
         self.COMSKIP_INI_PATH = os.path.expandvars(os.path.expanduser(config.get('Helper Apps', 'comskip-ini-path')))
         self.FFMPEG_PATH = os.path.expandvars(os.path.expanduser(config.get('Helper Apps', 'ffmpeg-path')))
+        self.FFPROBE_PATH = os.path.expandvars(os.path.expanduser(config.get('Helper Apps', 'ffprobe-path')))
+        if not self.FFPROBE_PATH:
+            self.FFPROBE_PATH = os.path.join(os.path.dirname(self.FFMPEG_PATH), 'ffprobe')
         self.MKCLEAN_PATH = os.path.expandvars(os.path.expanduser(config.get('Helper Apps', 'mkclean-path')))
         self.NVENC_SUPPORT = config.getboolean('Transcoding', 'nvenc_support')
         self.NVDEC_SUPPORT = config.getboolean('Transcoding', 'nvdec_support')
+        self.CAPABILITIES_PATH = os.path.expandvars(os.path.expanduser(config.get('Transcoding', 'capabilities-path')))
+        self.CAPABILITIES_TTL = config.getint('Transcoding', 'capabilities-ttl')
+        self.MKCLEAN_REMUX = config.getboolean('Transcoding', 'mkclean-remux')
+        self.CHUNK_WORKERS = config.getint('Transcoding', 'chunk-workers')
+        self.CHUNK_LENGTH = config.getfloat('Transcoding', 'chunk-length')
+        self.EARLY_ABORT = config.getboolean('Transcoding', 'early-abort')
+        self.EARLY_ABORT_INTERVAL = config.getfloat('Transcoding', 'early-abort-interval')
+        self.EARLY_ABORT_WINDOW = config.getint('Transcoding', 'early-abort-window')
+        self.EARLY_ABORT_MIN_PROGRESS = config.getfloat('Transcoding', 'early-abort-min-progress')
+        self.LIVE_IDLE_TIMEOUT = config.getfloat('Transcoding', 'live-idle-timeout')
         self.LOG_FILE_PATH = os.path.expandvars(os.path.expanduser(config.get('Logging', 'logfile-path')))
         self.CONSOLE_LOGGING = config.getboolean('Logging', 'console-logging')
+        self.LOG_FORMAT = config.get('Logging', 'log-format')
+        if self.LOG_FORMAT not in ['text', 'json']:
+            raise ValueError("Unknown log-format: {}".format(self.LOG_FORMAT))
+        self.METRICS_PATH = os.path.expandvars(os.path.expanduser(config.get('Logging', 'metrics-path')))
         self.TEMP_ROOT = os.path.expandvars(os.path.expanduser(config.get('File Manipulation', 'temp-root')))
         self.COPY_ORIGINAL = config.getboolean('File Manipulation', 'copy-original')
         self.SAVE_ALWAYS = config.getboolean('File Manipulation', 'save-always')
         self.SAVE_FORENSICS = config.getboolean('File Manipulation', 'save-forensics')
+        self.PROBE_CACHE = config.getboolean('File Manipulation', 'probe-cache')
+        self.PROBE_CACHE_PATH = os.path.expandvars(os.path.expanduser(config.get('File Manipulation', 'probe-cache-path')))
+        if not self.PROBE_CACHE_PATH:
+            self.PROBE_CACHE_PATH = os.path.join(self.TEMP_ROOT, 'probe_cache.sqlite')
+        if not self.CAPABILITIES_PATH:
+            self.CAPABILITIES_PATH = os.path.join(self.TEMP_ROOT, 'capabilities.json')
+        self.LEASES = config.getboolean('File Manipulation', 'leases')
+        self.LEASE_DIR = os.path.expandvars(os.path.expanduser(config.get('File Manipulation', 'lease-dir')))
+        self.LEASE_TTL = config.getint('File Manipulation', 'lease-ttl')
+        self.WATCH_SETTLE = config.getfloat('File Manipulation', 'watch-settle')
+        self.WATCH_POLL_INTERVAL = config.getfloat('File Manipulation', 'watch-poll-interval')
+        self.JOB_QUEUE = config.getboolean('Job Queue', 'job-queue')
+        self.JOB_QUEUE_PATH = os.path.expandvars(os.path.expanduser(config.get('Job Queue', 'job-queue-path')))
+        if not self.JOB_QUEUE_PATH:
+            self.JOB_QUEUE_PATH = os.path.join(self.TEMP_ROOT, 'jobs.sqlite')
+        self.JOB_SLOTS = {'sw_encode' : config.getint('Job Queue', 'sw-encode-slots'), 'hw_encode' : config.getint('Job Queue', 'hw-encode-slots'),
+                          'comskip' : config.getint('Job Queue', 'comskip-slots'), 'remux' : config.getint('Job Queue', 'remux-slots')}
+        self.JOB_RETRIES = config.getint('Job Queue', 'job-retries')
+        self.JOB_RETRY_BACKOFF = config.getint('Job Queue', 'job-retry-backoff')
+        self.JOB_LEASE = config.getint('Job Queue', 'job-lease')
+        self.DAEMON_SOCKET_PATH = os.path.expandvars(os.path.expanduser(config.get('Daemon', 'socket-path')))
+        if not self.DAEMON_SOCKET_PATH:
+            self.DAEMON_SOCKET_PATH = os.path.join(self.TEMP_ROOT, 'postprocess.sock')
+        self.DAEMON_MAX_PIPELINES = config.getint('Daemon', 'max-pipelines')
+        self.CUT_MODE = config.get('Comskip', 'cut-mode')
+        if self.CUT_MODE not in ['concat', 'segments', 'smartcut']:
+            raise ValueError("Unknown cut-mode: {}".format(self.CUT_MODE))
@@ -0,0 +1,139 @@
+import ctypes, ctypes.util, errno, fcntl, logging, os, uuid
+
+# Moving finished files into place without copying them through user space where we can help it. Files are staged
+# next to where they are going, on the same filesystem, and then swapped in with a rename, so nothing ever sees the
+# destination half written. Staging copies use a reflink where the filesystem can share blocks (btrfs, xfs), an
+# in-kernel copy_file_range where it can't, and a plain streamed copy that keeps out of the page cache otherwise.
+
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_DONTNEED = 4
+
+COPY_BLOCK_SIZE = 8 * 1024 * 1024
+
+# How much to stream between telling the kernel it can drop what we've read
+FADVISE_INTERVAL = 64 * 1024 * 1024
+
+# Errors meaning this way of copying isn't available here, rather than that the copy went wrong
+UNSUPPORTED = [errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF, errno.EPERM]
+
+libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+try:
+    libc.copy_file_range.restype = ctypes.c_ssize_t
+    libc.copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+except AttributeError:
+    # glibc older than 2.27
+    pass
+try:
+    libc.posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong, ctypes.c_int]
+except AttributeError:
+    pass
+
+def SameFilesystem(path, other_path):
+    return os.stat(path).st_dev == os.stat(os.path.dirname(os.path.abspath(other_path))).st_dev
+
+def StagingPath(destination):
+    # Hidden, so Plex and our own scanners leave it alone while it is being written
+    directory, name = os.path.split(os.path.abspath(destination))
+    return os.path.join(directory, '.{}.{}.tmp'.format(name, uuid.uuid4().hex[:8]))
+
+def Fadvise(fd, offset, length, advice):
+    # Only ever a hint, so it doesn't matter if it isn't there
+    try:
+        libc.posix_fadvise(fd, offset, length, advice)
+    except AttributeError:
+        pass
+
+def Reflink(source_fd, destination_fd):
+    try:
+        fcntl.ioctl(destination_fd, FICLONE, source_fd)
+        return True
+    except IOError, e:
+        if e.errno in UNSUPPORTED:
+            return False
+        raise
+
+def CopyFileRange(source_fd, destination_fd, size):
+    copied = 0
+    while copied < size:
+        try:
+            count = libc.copy_file_range(source_fd, None, destination_fd, None, min(size - copied, 1 << 30), 0)
+        except AttributeError:
+            return False
+        if count < 0:
+            error = ctypes.get_errno()
+            if error == errno.EINTR:
+                continue
+            if copied == 0 and error in UNSUPPORTED:
+                return False
+            raise OSError(error, os.strerror(error))
+        if count == 0:
+            # The source got shorter under us
+            break
+        copied += count
+    return True
+
+def StreamCopy(source_fd, destination_fd):
+    Fadvise(source_fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+    offset = 0
+    dropped = 0
+    while True:
+        block = os.read(source_fd, COPY_BLOCK_SIZE)
+        if not block:
+            break
+        view = memoryview(block)
+        while view:
+            view = view[os.write(destination_fd, view):]
+        offset += len(block)
+        if offset - dropped >= FADVISE_INTERVAL:
+            # We won't read this again, don't let tens of GB of it push everything else out of the cache
+            Fadvise(source_fd, dropped, offset - dropped, POSIX_FADV_DONTNEED)
+            dropped = offset
+    Fadvise(source_fd, 0, 0, POSIX_FADV_DONTNEED)
+
+def CopyFile(source, destination):
+    # Returns how the copy was made, for the log
+    with open(source, 'rb') as src:
+        with open(destination, 'wb') as dst:
+            if Reflink(src.fileno(), dst.fileno()):
+                method = 'reflink'
+            elif CopyFileRange(src.fileno(), dst.fileno(), os.fstat(src.fileno()).st_size):
+                method = 'copy_file_range'
+            else:
+                # copy_file_range may have moved the offsets before giving up
+                os.lseek(src.fileno(), 0, os.SEEK_SET)
+                os.lseek(dst.fileno(), 0, os.SEEK_SET)
+                os.ftruncate(dst.fileno(), 0)
+                StreamCopy(src.fileno(), dst.fileno())
+                method = 'streamed copy'
+            os.fsync(dst.fileno())
+            Fadvise(dst.fileno(), 0, 0, POSIX_FADV_DONTNEED)
+    return method
+
+def Install(path, destination):
+    # Swap path in for destination in one rename. It takes on destination's permissions, and its owner if we're
+    # allowed to, since whatever reads the library expects to find them unchanged.
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    if os.path.exists(destination):
+        st = os.stat(destination)
+        os.chmod(path, st.st_mode & 0o7777)
+        try:
+            os.chown(path, st.st_uid, st.st_gid)
+        except OSError, e:
+            if e.errno != errno.EPERM:
+                raise
+    os.rename(path, destination)
+
+    # Make the rename itself durable
+    fd = os.open(os.path.dirname(os.path.abspath(destination)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    logging.info('Swapped {} into place'.format(destination))
@@ -0,0 +1,233 @@
+#!/usr/bin/python
+import argparse, logging, os, socket, sqlite3, sys, threading, time
+import ConfigContainer, LogConfig
+
+# Resource classes a job can need. Each gets its own number of slots, so one host can keep the CPU encoder, the GPU
+# encoder, comskip and the disks all busy at once without piling more than they can take onto any of them.
+RESOURCES = ['sw_encode', 'hw_encode', 'comskip', 'remux']
+
+# Status a job returns when it failed in a way that retrying can't fix
+GIVE_UP = 2
+
+# Jobs on a path run one after the other in the order they were queued. A process keeps the jobs it is running
+# leased by touching them every so often; running jobs whose process died, or whose lease ran out on any host sharing
+# the database, go back to pending. Failed jobs are retried with exponential backoff.
+class JobQueue(object):
+    def __init__(self, db_path, retries, backoff, lease):
+        self.retries = retries
+        self.backoff = backoff
+        self.lease = lease
+        self.owner = '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.running = set()
+
+        if not os.path.isdir(os.path.dirname(db_path)):
+            os.makedirs(os.path.dirname(db_path))
+        self.db = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT, name TEXT, '
+                        'resource TEXT, state TEXT, attempts INTEGER DEFAULT 0, not_before REAL DEFAULT 0, owner TEXT, '
+                        'error TEXT, created REAL, updated REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, resource)')
+        self.db.commit()
+        self.recover()
+
+        self.heartbeat_thread = threading.Thread(target=self.heartbeat, name='JobQueueHeartbeat')
+        self.heartbeat_thread.daemon = True
+        self.heartbeat_thread.start()
+
+    def heartbeat(self):
+        # Renew the lease on our running jobs well before it runs out
+        while True:
+            time.sleep(self.lease / 4.0)
+            with self.lock:
+                if self.running:
+                    self.db.execute("UPDATE jobs SET updated = ? WHERE owner = ? AND state = 'running' AND id IN ({})".format(
+                        ', '.join('?' * len(self.running))), [time.time(), self.owner] + list(self.running))
+                    self.db.commit()
+
+    def recover(self):
+        # Anything still marked running by a process on this host that no longer exists was interrupted, and so was
+        # anything whose lease ran out, whichever host it was on
+        host = socket.gethostname()
+        stale = time.time() - self.lease
+        with self.lock:
+            for job_id, owner, updated in self.db.execute("SELECT id, owner, updated FROM jobs WHERE state = 'running'").fetchall():
+                if job_id in self.running:
+                    continue
+                owner_host, pid = owner.rsplit(':', 1)
+                if (owner_host == host and not self.alive(int(pid))) or updated < stale:
+                    logging.info('[JobQueue] Resuming job {} left running by {}'.format(job_id, owner))
+                    self.db.execute("UPDATE jobs SET state = 'pending', owner = NULL WHERE id = ? AND state = 'running' "
+                                    "AND owner = ?", (job_id, owner))
+                    self.changed.notify_all()
+            self.db.commit()
+
+    def alive(self, pid):
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            return False
+        return True
+
+    def submit(self, path, name, resource):
+        with self.lock:
+            # Already waiting or in progress from an earlier scan
+            if self.db.execute("SELECT 1 FROM jobs WHERE path = ? AND name = ? AND state IN ('pending', 'running')",
+                               (path, name)).fetchone() is not None:
+                return False
+            now = time.time()
+            self.db.execute("INSERT INTO jobs (path, name, resource, state, created, updated) VALUES (?, ?, ?, 'pending', ?, ?)",
+                            (path, name, resource, now, now))
+            self.db.commit()
+            self.changed.notify_all()
+        logging.info('[JobQueue] Queued {} for {}'.format(name, path))
+        return True
+
+    def claim(self, resource, names, runnable):
+        # Jobs are claimed by name, the resource a job needs is whatever its handler says now rather than what it said
+        # when it was queued, which can change with the config or with what the GPU turned out to be able to do. Jobs
+        # only wait behind earlier ones on the same path that we could run ourselves, a job nothing here handles would
+        # otherwise hold them up for good.
+        with self.lock:
+            while True:
+                now = time.time()
+                row = self.db.execute("SELECT id, path, name, attempts FROM jobs j WHERE state = 'pending' AND name IN ({}) "
+                                      "AND not_before <= ? AND NOT EXISTS (SELECT 1 FROM jobs p WHERE p.path = j.path AND "
+                                      "p.id < j.id AND p.state IN ('pending', 'running') AND p.name IN ({})) "
+                                      "ORDER BY id LIMIT 1".format(', '.join('?' * len(names)), ', '.join('?' * len(runnable))),
+                                      list(names) + [now] + list(runnable)).fetchone()
+                if row is None:
+                    return None
+
+                # Another process sharing the database may have beaten us to it
+                cursor = self.db.execute("UPDATE jobs SET state = 'running', owner = ?, resource = ?, attempts = attempts + 1, "
+                                         "updated = ? WHERE id = ? AND state = 'pending'", (self.owner, resource, now, row[0]))
+                self.db.commit()
+                if cursor.rowcount == 1:
+                    self.running.add(row[0])
+                    return row[0], row[1], row[2], row[3] + 1
+
+    def finish(self, job_id, attempts, status, error=None):
+        # Only while the job is still ours, if our lease ran out it may have been handed to someone else
+        with self.lock:
+            self.running.discard(job_id)
+            now = time.time()
+            if status == 0:
+                self.db.execute("UPDATE jobs SET state = 'done', error = NULL, updated = ? WHERE id = ? AND owner = ?",
+                                (now, job_id, self.owner))
+            elif status != GIVE_UP and attempts < self.retries:
+                delay = self.backoff * 2 ** (attempts - 1)
+                self.db.execute("UPDATE jobs SET state = 'pending', owner = NULL, error = ?, not_before = ?, updated = ? "
+                                "WHERE id = ? AND owner = ?", (error, now + delay, now, job_id, self.owner))
+            else:
+                self.db.execute("UPDATE jobs SET state = 'failed', error = ?, updated = ? WHERE id = ? AND owner = ?",
+                                (error, now, job_id, self.owner))
+            self.db.commit()
+            self.changed.notify_all()
+
+    def outstanding(self, names):
+        # Jobs we could still end up running, the running ones may yet come back to pending
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM jobs WHERE state IN ('pending', 'running') AND name IN ({})".format(
+                ', '.join('?' * len(names))), list(names)).fetchone()[0]
+
+    def wait(self, timeout):
+        with self.lock:
+            self.changed.wait(timeout)
+
+    def jobs(self, state=None):
+        with self.lock:
+            if state is None:
+                return self.db.execute('SELECT id, path, name, resource, state, attempts, error FROM jobs ORDER BY id').fetchall()
+            return self.db.execute('SELECT id, path, name, resource, state, attempts, error FROM jobs WHERE state = ? '
+                                   'ORDER BY id', (state,)).fetchall()
+
+    def retry_failed(self):
+        with self.lock:
+            count = self.db.execute("UPDATE jobs SET state = 'pending', attempts = 0, not_before = 0, owner = NULL "
+                                    "WHERE state = 'failed'").rowcount
+            self.db.commit()
+        return count
+
+class JobRunner(object):
+    # How often idle workers look again for jobs whose backoff has run out
+    POLL_INTERVAL = 5
+
+    def __init__(self, queue, handlers, slots):
+        # handlers maps a job name to (resource, function(path) returning 0 on success, 1 on failure or GIVE_UP)
+        self.queue = queue
+        self.handlers = handlers
+        self.slots = slots
+        self.submitting = True
+        self.threads = []
+
+    def start(self):
+        for resource in set(resource for resource, handler in self.handlers.values()):
+            names = [name for name, (job_resource, handler) in self.handlers.iteritems() if job_resource == resource]
+            for slot in range(max(1, self.slots.get(resource, 1))):
+                thread = threading.Thread(target=self.work, args=(resource, names))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def work(self, resource, names):
+        while True:
+            job = self.queue.claim(resource, names, self.handlers.keys())
+            if job is None:
+                # Jobs another host was running may be stuck behind a lease that has run out
+                self.queue.recover()
+                if not self.submitting and self.queue.outstanding(self.handlers.keys()) == 0:
+                    return
+                self.queue.wait(self.POLL_INTERVAL)
+                continue
+
+            job_id, path, name, attempts = job
+            status, error = 1, None
+            try:
+                with LogConfig.Context(job=job_id):
+                    status = self.handlers[name][1](path)
+            except Exception, e:
+                error = str(e)
+                logging.error('[JobQueue] {} of {} raised: {}'.format(name, path, e))
+            self.queue.finish(job_id, attempts, status, error)
+
+    def join(self):
+        # Everything has been queued, let the workers exit once it has all run
+        self.submitting = False
+        with self.queue.lock:
+            self.queue.changed.notify_all()
+        # Join with a timeout so Ctrl+C still gets through to us
+        while any(thread.is_alive() for thread in self.threads):
+            for thread in self.threads:
+                thread.join(1)
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+# One connection, and so one heartbeat thread, per process, however many scans a watch runs
+def GetJobQueue(config):
+    with _queues_lock:
+        if config.JOB_QUEUE_PATH not in _queues:
+            _queues[config.JOB_QUEUE_PATH] = JobQueue(config.JOB_QUEUE_PATH, config.JOB_RETRIES, config.JOB_RETRY_BACKOFF,
+                                                      config.JOB_LEASE)
+        return _queues[config.JOB_QUEUE_PATH]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--state", choices=['pending', 'running', 'done', 'failed'], help="Only list jobs in this state")
+    parser.add_argument("--retry-failed", action='store_true', help="Put every failed job back in the queue")
+    args = parser.parse_args()
+
+    config_file_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'scripts.conf')
+    queue = GetJobQueue(ConfigContainer.ConfigContainer(config_file_path))
+
+    if args.retry_failed:
+        print('Requeued {} failed jobs'.format(queue.retry_failed()))
+    else:
+        for job_id, path, name, resource, state, attempts, error in queue.jobs(args.state):
+            print('{:>6} {:<8} {:<10} {:<9} {} {}{}'.format(job_id, state, name, resource, attempts, path,
+                                                          ' ({})'.format(error) if error else ''))
+
+    sys.exit(0)
@@ -0,0 +1,145 @@
+import errno, hashlib, json, logging, os, socket, threading, time, uuid
+
+# Claims on media files, so several hosts sharing one library never work on the same file at once. A claim is a lock
+# file created with O_EXCL, either next to the media or in a shared lease directory. Its holder touches it every
+# heartbeat, and anyone may break it once it has gone ttl seconds without one.
+
+class Lease(object):
+    def __init__(self, manager, media_path, lease_path, token):
+        self.manager = manager
+        self.media_path = media_path
+        self.lease_path = lease_path
+        self.token = token
+        self.lost = False
+
+    def renew(self):
+        # It may have expired and been broken while we were busy, touching it then would keep the new holder's claim
+        # alive for them and hide from us that the file isn't ours any more
+        if self.manager.read_token(self.lease_path) != self.token:
+            logging.error('Lost the lease on {}, another host has claimed it'.format(self.media_path))
+            self.lost = True
+            self.manager.forget(self)
+            return
+        try:
+            os.utime(self.lease_path, None)
+        except OSError, e:
+            logging.error('Could not renew the lease on {}: {}'.format(self.media_path, e))
+
+    def release(self):
+        self.manager.forget(self)
+
+        # Only remove the lock file if it is still ours, it may have expired and been claimed by someone else
+        if self.manager.read_token(self.lease_path) == self.token:
+            try:
+                os.remove(self.lease_path)
+            except OSError:
+                pass
+
+class LeaseManager(object):
+    def __init__(self, lease_dir, ttl):
+        self.lease_dir = lease_dir
+        self.ttl = ttl
+        self.heartbeat = max(1, ttl / 4)
+        self.owner = '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.lock = threading.Lock()
+        self.held = []
+
+        if lease_dir and not os.path.isdir(lease_dir):
+            os.makedirs(lease_dir)
+
+        self.thread = threading.Thread(target=self.renew_all)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def lease_path(self, media_path):
+        media_path = os.path.abspath(media_path)
+        if self.lease_dir:
+            return os.path.join(self.lease_dir, hashlib.sha1(media_path).hexdigest() + '.lease')
+        return os.path.join(os.path.dirname(media_path), '.' + os.path.basename(media_path) + '.lease')
+
+    def read_token(self, lease_path):
+        try:
+            with open(lease_path, 'r') as f:
+                return json.load(f).get('token')
+        except (IOError, ValueError):
+            return None
+
+    def expired(self, lease_path):
+        try:
+            return time.time() - os.path.getmtime(lease_path) > self.ttl
+        except OSError:
+            # It went away while we were looking, so it is not in our way any more
+            return True
+
+    def acquire(self, media_path):
+        lease_path = self.lease_path(media_path)
+
+        for attempt in range(2):
+            token = str(uuid.uuid4())
+            try:
+                fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0644)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+                if attempt > 0 or not self.expired(lease_path) or not self.break_lease(lease_path):
+                    return None
+                continue
+
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'token' : token, 'owner' : self.owner, 'path' : os.path.abspath(media_path), 'acquired' : time.time()}, f)
+
+            lease = Lease(self, media_path, lease_path, token)
+            with self.lock:
+                self.held.append(lease)
+            logging.info('Claimed {}'.format(media_path))
+            return lease
+
+        return None
+
+    def break_lease(self, lease_path):
+        stale_token = self.read_token(lease_path)
+        logging.info('Breaking expired lease {}'.format(lease_path))
+
+        # Move it aside first; of several hosts breaking the same lease, only one rename can succeed
+        tombstone = '{}.stale-{}'.format(lease_path, uuid.uuid4())
+        try:
+            os.rename(lease_path, tombstone)
+        except OSError:
+            return False
+
+        # Someone else may have broken and re-claimed it between our check and our rename. Put theirs back.
+        if self.read_token(tombstone) != stale_token:
+            try:
+                os.link(tombstone, lease_path)
+            except OSError:
+                pass
+            os.remove(tombstone)
+            return False
+
+        os.remove(tombstone)
+        return True
+
+    def forget(self, lease):
+        with self.lock:
+            if lease in self.held:
+                self.held.remove(lease)
+
+    def renew_all(self):
+        while True:
+            time.sleep(self.heartbeat)
+            with self.lock:
+                held = list(self.held)
+            for lease in held:
+                lease.renew()
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+# One manager, and so one heartbeat thread, per process
+def GetLeaseManager(config):
+    if not config.LEASES:
+        return None
+    with _managers_lock:
+        if config.LEASE_DIR not in _managers:
+            _managers[config.LEASE_DIR] = LeaseManager(config.LEASE_DIR, config.LEASE_TTL)
+        return _managers[config.LEASE_DIR]
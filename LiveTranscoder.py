@@ -0,0 +1,300 @@
+#!/usr/bin/python
+import argparse, logging, multiprocessing, os, shutil, sys, time
+import MediaProcessor, Transcoder
+from pymediainfo import MediaInfo
+from multiprocessing.pool import ThreadPool
+
+# Transcodes a recording while the DVR is still writing it. We follow the .ts file as it grows, cut it into chunks at
+# video keyframes every chunk-length seconds or so, and encode each chunk as soon as it is complete. Once the file
+# stops growing, only the last short chunk is left to encode before the chunks are joined up.
+
+TS_PACKET_SIZE = 188
+
+# Wraparound of the 33 bit MPEG-TS presentation timestamps, and their 90kHz clock
+PTS_WRAP = 1 << 33
+PTS_CLOCK = 90000.0
+
+# How often to look for more of the file when we have caught up with the writer
+FOLLOW_INTERVAL = 2
+
+def PacketPID(packet):
+    return ((ord(packet[1]) & 0x1F) << 8) | ord(packet[2])
+
+def PacketPayload(packet):
+    # Returns the payload, and whether the adaptation field flagged this as a random access point
+    control = (ord(packet[3]) >> 4) & 0x3
+    position = 4
+    random_access = False
+    if control & 0x2:
+        length = ord(packet[4])
+        if length > 0:
+            random_access = bool(ord(packet[5]) & 0x40)
+        position += 1 + length
+    if not control & 0x1 or position >= TS_PACKET_SIZE:
+        return None, random_access
+    return packet[position:], random_access
+
+# PMT stream types we can split on
+MPEG2_VIDEO = [0x01, 0x02]
+H264_VIDEO = 0x1B
+HEVC_VIDEO = 0x24
+VIDEO_STREAM_TYPES = MPEG2_VIDEO + [0x10, H264_VIDEO, HEVC_VIDEO, 0xEA]
+
+def StartsDecodable(es, stream_type):
+    # Whether the picture at the start of this elementary stream data can be decoded without the ones before it.
+    # Every H.264 and HEVC picture in broadcast TS starts with an access unit delimiter, so look past that (and any SEI)
+    # to the parameter sets or slice behind it.
+    position = es.find('\x00\x00\x01')
+    while 0 <= position and position + 3 < len(es):
+        code = ord(es[position + 3])
+        if stream_type in MPEG2_VIDEO:
+            # Sequence header, or a GOP header which only comes ahead of an I frame
+            if code in [0xB3, 0xB8]:
+                return True
+            if code == 0x00:
+                return False
+        elif stream_type == H264_VIDEO:
+            # SPS or IDR slice, where any other slice means this picture leans on earlier ones
+            if code & 0x1F in [5, 7]:
+                return True
+            if code & 0x1F in [1, 2, 3, 4]:
+                return False
+        elif stream_type == HEVC_VIDEO:
+            # VPS, SPS or an IRAP slice
+            if (code >> 1) & 0x3F in [32, 33] or 16 <= (code >> 1) & 0x3F <= 23:
+                return True
+            if (code >> 1) & 0x3F <= 9:
+                return False
+        else:
+            return False
+        position = es.find('\x00\x00\x01', position + 3)
+    return False
+
+def KeyframePTS(packet, stream_type):
+    # The PTS of the video frame starting in this packet, if it is one we can start decoding from. Plenty of broadcast
+    # muxers don't set random_access_indicator, so also look at what the PES payload starts with.
+    if not ord(packet[1]) & 0x40:
+        return None
+    payload, random_access = PacketPayload(packet)
+    if payload is None or len(payload) < 14 or payload[:3] != '\x00\x00\x01' or not ord(payload[7]) & 0x80:
+        return None
+
+    if not random_access and not StartsDecodable(payload[9 + ord(payload[8]):], stream_type):
+        return None
+
+    pts = payload[9:14]
+    return (((ord(pts[0]) >> 1) & 0x7) << 30) | (ord(pts[1]) << 22) | ((ord(pts[2]) >> 1) << 15) | \
+           (ord(pts[3]) << 7) | (ord(pts[4]) >> 1)
+
+class TSFollower(object):
+    # Reads whole packets off the end of a file that is still being written
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.buffer = ''
+        self.pmt_pid = None
+        self.video_pid = None
+        self.video_type = None
+        self.psi = {}
+
+    def packets(self):
+        self.buffer += self.file.read(1024 * 1024)
+        position = 0
+        while position + TS_PACKET_SIZE <= len(self.buffer):
+            if self.buffer[position] != '\x47':
+                # Lost sync, skip ahead to the next sync byte
+                position += 1
+                continue
+            packet = self.buffer[position:position + TS_PACKET_SIZE]
+            position += TS_PACKET_SIZE
+            self.track_psi(packet)
+            yield packet
+        self.buffer = self.buffer[position:]
+
+    def track_psi(self, packet):
+        # Hold on to the latest PAT and PMT so every chunk can start with them
+        pid = PacketPID(packet)
+        if pid == 0:
+            self.psi[0] = packet
+            payload, random_access = PacketPayload(packet)
+            if self.pmt_pid is None and payload is not None and ord(packet[1]) & 0x40:
+                section = payload[1 + ord(payload[0]):]
+                for position in range(8, min(len(section) - 4, 3 + (((ord(section[1]) & 0x0F) << 8) | ord(section[2])) - 4), 4):
+                    if (ord(section[position]) << 8) | ord(section[position + 1]) != 0:
+                        self.pmt_pid = ((ord(section[position + 2]) & 0x1F) << 8) | ord(section[position + 3])
+                        break
+        elif pid == self.pmt_pid:
+            self.psi[pid] = packet
+            payload, random_access = PacketPayload(packet)
+            if self.video_pid is None and payload is not None and ord(packet[1]) & 0x40:
+                section = payload[1 + ord(payload[0]):]
+                end = min(len(section) - 4, 3 + (((ord(section[1]) & 0x0F) << 8) | ord(section[2])) - 4)
+                position = 12 + (((ord(section[10]) & 0x0F) << 8) | ord(section[11]))
+                while position + 5 <= end:
+                    if ord(section[position]) in VIDEO_STREAM_TYPES:
+                        self.video_type = ord(section[position])
+                        self.video_pid = ((ord(section[position + 1]) & 0x1F) << 8) | ord(section[position + 2])
+                        break
+                    position += 5 + (((ord(section[position + 3]) & 0x0F) << 8) | ord(section[position + 4]))
+
+    def close(self):
+        self.file.close()
+
+class LiveTranscoder(Transcoder.Transcoder):
+    @MediaProcessor.metered('live-transcode')
+    @MediaProcessor.exception_logger
+    def FollowTranscode(self, path, codec, crf, speed):
+        logging.info('Following {} while it records'.format(path))
+        follower = TSFollower(path)
+        pool = ThreadPool(max(1, self.config.CHUNK_WORKERS))
+        self.live_encodes = []
+        self.live_params = None
+
+        chunk = None
+        chunk_start = None
+        last_growth = time.time()
+        try:
+            while True:
+                grew = False
+                for packet in follower.packets():
+                    grew = True
+                    pts = KeyframePTS(packet, follower.video_type) if PacketPID(packet) == follower.video_pid else None
+                    if pts is not None:
+                        if chunk_start is None:
+                            chunk_start = pts
+                        elif (pts - chunk_start) % PTS_WRAP >= self.config.CHUNK_LENGTH * PTS_CLOCK:
+                            # A whole chunk is in, start encoding it while we carry on reading
+                            self.EncodeLiveChunk(pool, chunk, codec, crf, speed)
+                            chunk = None
+                            chunk_start = pts
+                    if chunk is None:
+                        chunk = self.OpenLiveChunk(follower)
+                    chunk.write(packet)
+
+                if grew:
+                    last_growth = time.time()
+                elif time.time() - last_growth >= self.config.LIVE_IDLE_TIMEOUT:
+                    logging.info('{} has not grown for {} seconds, taking the recording as finished'.format(path, self.config.LIVE_IDLE_TIMEOUT))
+                    break
+                else:
+                    time.sleep(FOLLOW_INTERVAL)
+
+            if chunk is not None:
+                self.EncodeLiveChunk(pool, chunk, codec, crf, speed)
+            if follower.video_pid is None:
+                raise Exception("Could not find a video stream in {}".format(path))
+
+            outputs = [result.get() for result in self.live_encodes]
+        finally:
+            follower.close()
+            pool.close()
+            pool.join()
+
+        return self.JoinLiveChunks(path, outputs)
+
+    def OpenLiveChunk(self, follower):
+        chunk_path = os.path.join(self.temp_dir, 'live-%04d.ts' % len(self.live_encodes))
+        chunk = open(chunk_path, 'wb')
+        # Each chunk must be decodable by itself, so it starts with the stream tables
+        for pid in sorted(follower.psi):
+            chunk.write(follower.psi[pid])
+        return chunk
+
+    def EncodeLiveChunk(self, pool, chunk, codec, crf, speed):
+        chunk.close()
+        chunk_path = chunk.name
+        # Not through the probe cache, the chunk is gone as soon as it is encoded
+        mediainfo = MediaInfo.parse(chunk_path)
+
+        # Settle the encoder on the first chunk, so every chunk comes out the same and they can be joined losslessly
+        if self.live_params is None:
+            self.live_params = {'codec' : codec, 'crf' : crf, 'speed' : speed}
+            if codec == 'auto':
+                self.live_params = self.AutoSelectEncParameters(mediainfo)
+
+        # Just the video, audio frames straddling the split between chunks would be cut short. The audio comes over from
+        # the finished recording when the chunks are joined.
+        output_path = os.path.splitext(chunk_path)[0] + '.mkv'
+        cmds = self.BuildFFMPEGCommands(chunk_path, mediainfo, self.live_params['codec'], self.live_params['crf'],
+                                        self.live_params['speed'], options={'output_path' : output_path, 'video_only' : True})
+        logging.info('Encoding {} while the recording carries on'.format(os.path.basename(chunk_path)))
+        self.live_encodes.append(pool.apply_async(self.EncodeLiveCommands, (cmds, chunk_path, mediainfo)))
+
+    def EncodeLiveCommands(self, cmds, chunk_path, mediainfo):
+        self.RunEncodeCommands(cmds, chunk_path, mediainfo)
+        os.remove(chunk_path)
+        return cmds[-1][-1]
+
+    @MediaProcessor.exception_logger
+    def JoinLiveChunks(self, path, outputs):
+        chunk_list_path = os.path.join(self.temp_dir, 'live-chunks.txt')
+        with open(chunk_list_path, 'w') as chunk_list:
+            for output in outputs:
+                chunk_list.write("file '{}'\n".format(output.replace("'", "'\\''")))
+
+        # Bring the audio and subtitles over from the finished recording, as ChunkedTranscode does
+        sub_cmd = []
+        for stream_identifier in self.SubtitleExclusions(self.probe_cache.parse(path)):
+            sub_cmd.extend(['-map', '-1:s:' + str(stream_identifier)])
+        if len(sub_cmd) > 0:
+            sub_cmd = ['-map', '1:s'] + sub_cmd
+
+        temp_path = os.path.join(self.temp_dir, os.path.splitext(os.path.basename(path))[0] + '.mkv')
+        cmd = ['nice', '-n20', self.config.FFMPEG_PATH, '-y', '-f', 'concat', '-safe', '0', '-i', chunk_list_path, '-i', path,
+               '-map', '0:v', '-map', '1:a'] + sub_cmd + ['-c', 'copy'] + self.MatroskaArgs(temp_path, self.MediaDuration(path)) + [temp_path]
+        self.Call(cmd)
+
+        logging.info('Finished processing: {}, transcoded file: {}'.format(path, temp_path))
+        return temp_path
+
+def SimulateRecording(source, destination, rate):
+    # Stands in for the DVR: copy source to destination at rate bytes a second, so the follower can be tried out
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        while True:
+            block = src.read(max(TS_PACKET_SIZE, int(rate) // 10))
+            if not block:
+                return
+            dst.write(block)
+            dst.flush()
+            time.sleep(0.1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input_file", required = True, help="Recording to follow")
+    parser.add_argument("-o", "--output_file", help="Where to put the transcode, instead of replacing the recording with it")
+    parser.add_argument("--codec", default='auto', choices=['auto', 'x265', 'hevc_nvenc', 'x264', 'h264_nvenc', 'vp9'], help="What codec to use for the encoding")
+    parser.add_argument("--crf", default='23', choices=map(str, range(0, 51)), help="What quality to use when for encoded (lower is higher quality and bigger files)")
+    parser.add_argument("--speed", default='medium', choices=['ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium', 'slow', 'slower', 'veryslow', 'placebo', 'hq'], help="Encoding speed (faster encoding is results in a less efficient representation)")
+    parser.add_argument("--simulate-from", help="Write this recording into the input file over time and follow that, for testing")
+    parser.add_argument("--simulate-rate", type=float, default=4 * 1024 * 1024, help="Bytes per second to write when simulating a recording")
+    args = parser.parse_args()
+
+    config_file_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'scripts.conf')
+    transcoder = LiveTranscoder(config_file_path)
+
+    writer = None
+    if args.simulate_from:
+        writer = multiprocessing.Process(target=SimulateRecording, args=(args.simulate_from, args.input_file, args.simulate_rate))
+        writer.start()
+        while not os.path.exists(args.input_file):
+            time.sleep(0.1)
+
+    try:
+        output_file = transcoder.FollowTranscode(args.input_file, args.codec, args.crf, args.speed)
+    except Exception, e:
+        transcoder.Error('Could not transcode {} as it recorded: {}'.format(args.input_file, e))
+        sys.exit(1)
+    finally:
+        if writer is not None:
+            writer.join()
+
+    if args.output_file:
+        shutil.move(output_file, args.output_file)
+        ret = 0
+    else:
+        ret = transcoder.SafeOverwrite(args.input_file, output_file)
+        if ret == 0:
+            # Make sure it ends with .mkv
+            os.rename(args.input_file, os.path.splitext(args.input_file)[0] + '.mkv')
+    transcoder.Cleanup()
+    sys.exit(ret)
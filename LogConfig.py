@@ -0,0 +1,140 @@
+import atexit, contextlib, json, logging, os, Queue, subprocess, threading
+from logging.handlers import RotatingFileHandler
+
+# Process wide logging, set up once however many processors and scanners get created. Records are handed to a queue
+# and a listener thread does the formatting and file writes, so slow log storage never holds up the thread doing the
+# work. Every record is tagged with the session and job it was logged for.
+
+# Tags of whatever this thread is working on right now
+context = threading.local()
+
+@contextlib.contextmanager
+def Context(**tags):
+    # Tags left as None keep their current value
+    saved = dict((name, getattr(context, name, None)) for name in tags)
+    for name, value in tags.iteritems():
+        if value is not None:
+            setattr(context, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.iteritems():
+            setattr(context, name, value)
+
+class ContextFilter(logging.Filter):
+    def filter(self, record):
+        # Runs on the thread that logged the record, the listener thread wouldn't know what it was working on
+        record.session = getattr(context, 'session', None) or ''
+        record.session_short = record.session[:6]
+        record.job = getattr(context, 'job', None)
+        return True
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'time' : record.created, 'level' : record.levelname, 'logger' : record.name, 'thread' : record.threadName,
+                 'session' : record.session, 'job' : record.job, 'message' : record.getMessage()}
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry)
+
+# The logging module in Python 2 has no QueueHandler or QueueListener, so these are cut down versions of those
+class QueueHandler(logging.Handler):
+    def __init__(self, queue, listener):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.listener = listener
+
+    def emit(self, record):
+        try:
+            # Render the message now, its arguments may have changed by the time the listener gets to it
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+            if self.listener.running:
+                self.queue.put_nowait(record)
+            else:
+                # Late records from interpreter shutdown, after the listener has gone
+                self.listener.handle(record)
+        except Exception:
+            self.handleError(record)
+
+class QueueListener(object):
+    def __init__(self, queue, handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='LogListener')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            self.handle(record)
+
+    def handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def stop(self):
+        # Drain whatever is still queued before the process exits
+        if self.running:
+            self.running = False
+            self.queue.put(None)
+            self.thread.join()
+
+_configured = False
+_configure_lock = threading.Lock()
+
+def Configure(config):
+    global _configured
+    with _configure_lock:
+        if _configured:
+            return
+        _configured = True
+
+        if config.LOG_FORMAT == 'json':
+            formatter = JSONFormatter()
+        else:
+            formatter = logging.Formatter('%(asctime)-15s [MediaProcessor: %(session_short)s] %(message)s')
+
+        handler = RotatingFileHandler(config.LOG_FILE_PATH, mode='a', maxBytes=8 * 1024 * 1024, backupCount=2)
+        handler.setFormatter(formatter)
+        handler.setLevel(logging.INFO)
+        handlers = [handler]
+
+        # Split the log output to the console
+        if config.CONSOLE_LOGGING:
+            console = logging.StreamHandler()
+            console.setLevel(logging.INFO)
+            console.setFormatter(formatter if config.LOG_FORMAT == 'json' else logging.Formatter('%(message)s'))
+            handlers.append(console)
+
+        queue = Queue.Queue()
+        listener = QueueListener(queue, handlers)
+        queue_handler = QueueHandler(queue, listener)
+        queue_handler.addFilter(ContextFilter())
+
+        logger = logging.getLogger('')
+        logger.setLevel(logging.INFO)
+        logger.addHandler(queue_handler)
+        listener.start()
+        atexit.register(listener.stop)
+
+    # If we're in a git repo, let's see if we can report our sha.
+    logging.info('Script was invoked from %s' % os.getcwd())
+    try:
+        git_sha = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=open(os.devnull, 'w'),
+                                          cwd=os.path.dirname(os.path.realpath(__file__)))
+        if git_sha:
+            logging.info('Using version: %s' % git_sha.strip())
+    except: pass
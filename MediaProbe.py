@@ -0,0 +1,251 @@
+import os, json, sqlite3, threading, collections, logging
+from pymediainfo import MediaInfo
+
+# Track fields the scanner rules and the transcoder look at. Everything else MediaInfo reports is left out of the cache.
+TRACK_FIELDS = ['track_type', 'codec', 'codec_id', 'codecs_video', 'format', 'format_profile', 'file_extension',
+                'file_size', 'duration', 'scan_type', 'language', 'stream_identifier', 'default', 'forced', 'width',
+                'height', 'frame_rate', 'bit_rate', 'channel_s']
+
+# Compact stand-ins for pymediainfo's Track and MediaInfo that only carry TRACK_FIELDS. These are what the scanners
+# hold on to for every match, so keep them slotted.
+class TrackSummary(object):
+    __slots__ = TRACK_FIELDS
+
+    def __init__(self, data):
+        for field, value in data.iteritems():
+            setattr(self, field, value)
+
+    def __getattr__(self, name):
+        # Behave like pymediainfo and report None for anything the file didn't have
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return None
+
+    def to_data(self):
+        data = {}
+        for field in TRACK_FIELDS:
+            value = getattr(self, field)
+            if value is not None:
+                data[field] = value
+        return data
+
+class MediaSummary(object):
+    __slots__ = ['tracks', 'partial']
+
+    def __init__(self, tracks, partial=False):
+        self.tracks = [TrackSummary(track) for track in tracks]
+        # Set when this only came from sniffing the header, rather than a full probe
+        self.partial = partial
+
+    def to_data(self):
+        return {'tracks': [track.to_data() for track in self.tracks]}
+
+class ProbeCache(object):
+    # Number of recent probes to also keep in memory
+    MEMO_SIZE = 256
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.memo = collections.OrderedDict()
+        self.db = None
+
+        if db_path:
+            try:
+                if not os.path.isdir(os.path.dirname(db_path)):
+                    os.makedirs(os.path.dirname(db_path))
+                self.db = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+                # Everything in here can be rebuilt by probing again, so don't pay for durability
+                self.db.execute('PRAGMA synchronous=OFF')
+                self.db.execute('CREATE TABLE IF NOT EXISTS probes (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, '
+                                'inode INTEGER, tracks TEXT)')
+                self.db.execute('CREATE TABLE IF NOT EXISTS keyframes (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, '
+                                'inode INTEGER, times TEXT)')
+                self.db.commit()
+            except Exception, e:
+                logging.error('Could not open the probe cache at {}, probing without it: {}'.format(db_path, e))
+                self.db = None
+
+    def file_key(self, path):
+        st = os.stat(path)
+        return (st.st_size, st.st_mtime, st.st_ino)
+
+    def lookup(self, path, key):
+        with self.lock:
+            if self.memo.get(path, (None,))[0] == key:
+                return self.memo[path][1]
+
+            if self.db is not None:
+                row = self.db.execute('SELECT size, mtime, inode, tracks FROM probes WHERE path = ?', (path,)).fetchone()
+                if row is not None and tuple(row[:3]) == key:
+                    tracks = json.loads(row[3])
+                    self.remember(path, key, tracks)
+                    return tracks
+        return None
+
+    def store(self, path, key, tracks):
+        with self.lock:
+            self.remember(path, key, tracks)
+            if self.db is not None:
+                try:
+                    self.db.execute('INSERT OR REPLACE INTO probes (path, size, mtime, inode, tracks) VALUES (?, ?, ?, ?, ?)',
+                                    (path,) + key + (json.dumps(tracks),))
+                    self.db.commit()
+                except sqlite3.Error, e:
+                    logging.error('Could not update the probe cache for {}: {}'.format(path, e))
+
+    def remember(self, path, key, tracks):
+        self.memo.pop(path, None)
+        self.memo[path] = (key, tracks)
+        while len(self.memo) > self.MEMO_SIZE:
+            self.memo.popitem(last=False)
+
+    def parse(self, path):
+        path = os.path.abspath(path)
+        key = self.file_key(path)
+
+        tracks = self.lookup(path, key)
+        if tracks is None:
+            # Probe outside the lock so concurrent probe workers don't serialise on us
+            mediainfo = MediaInfo.parse(path)
+            tracks = []
+            for track in mediainfo.tracks:
+                tracks.append(dict((field, getattr(track, field)) for field in TRACK_FIELDS if getattr(track, field) is not None))
+            self.store(path, key, tracks)
+
+        return MediaSummary(tracks)
+
+    def keyframes(self, path, scan):
+        # scan(path) builds the index when we don't have an up to date one
+        path = os.path.abspath(path)
+        key = self.file_key(path)
+
+        with self.lock:
+            if self.db is not None:
+                row = self.db.execute('SELECT size, mtime, inode, times FROM keyframes WHERE path = ?', (path,)).fetchone()
+                if row is not None and tuple(row[:3]) == key:
+                    return json.loads(row[3])
+
+        times = scan(path)
+        with self.lock:
+            if self.db is not None:
+                try:
+                    self.db.execute('INSERT OR REPLACE INTO keyframes (path, size, mtime, inode, times) VALUES (?, ?, ?, ?, ?)',
+                                    (path,) + key + (json.dumps(times),))
+                    self.db.commit()
+                except sqlite3.Error, e:
+                    logging.error('Could not update the keyframe index for {}: {}'.format(path, e))
+        return times
+
+# How much of the start of a file SniffHeader reads
+SNIFF_SIZE = 64 * 1024
+
+# MPEG-TS PMT stream types, named the way MediaInfo reports them in codecs_video
+TS_VIDEO_STREAM_TYPES = {0x01 : 'MPEG-1 Video', 0x02 : 'MPEG-2 Video', 0x10 : 'MPEG-4 Visual', 0x1B : 'AVC', 0x24 : 'HEVC', 0xEA : 'VC-1'}
+
+def ReadVint(data, pos, strip_marker=True):
+    # EBML variable length integer, returns the value and the position after it
+    length = 1
+    while length <= 8 and not data[pos] & (0x80 >> (length - 1)):
+        length += 1
+    if length > 8:
+        raise ValueError('Bad EBML vint at offset %s' % pos)
+    value = data[pos] & ((0xFF >> length) if strip_marker else 0xFF)
+    for byte in data[pos + 1:pos + length]:
+        value = (value << 8) | byte
+    return value, pos + length
+
+def SniffEBMLDocType(data):
+    # Walk the EBML header's children looking for the DocType element
+    header_size, pos = ReadVint(data, 4)
+    end = min(pos + header_size, len(data))
+    while pos < end:
+        element_id, pos = ReadVint(data, pos, strip_marker=False)
+        size, pos = ReadVint(data, pos)
+        if element_id == 0x4282:
+            return str(data[pos:pos + size]).rstrip('\0')
+        pos += size
+    return None
+
+def SniffTSVideoCodecs(data):
+    # Find the first program's PMT and name its video streams. Sections are assumed to fit in one TS packet, which
+    # holds for the PAT and PMT of any broadcast capture we've seen.
+    pmt_pid = None
+    for offset in range(0, len(data) - 187, 188):
+        packet = data[offset:offset + 188]
+        if packet[0] != 0x47 or not packet[1] & 0x40:
+            continue
+        pid = ((packet[1] & 0x1F) << 8) | packet[2]
+        payload = 4
+        if packet[3] & 0x20:
+            payload += 1 + packet[4]
+        if not packet[3] & 0x10 or payload >= 188:
+            continue
+        section = packet[payload + 1 + packet[payload]:]
+        if len(section) < 12:
+            continue
+        section_end = min(3 + (((section[1] & 0x0F) << 8) | section[2]) - 4, len(section))
+
+        if pid == 0 and section[0] == 0x00 and pmt_pid is None:
+            for pos in range(8, section_end - 3, 4):
+                if (section[pos] << 8) | section[pos + 1] != 0:
+                    pmt_pid = ((section[pos + 2] & 0x1F) << 8) | section[pos + 3]
+                    break
+
+        elif pid == pmt_pid and section[0] == 0x02:
+            codecs = []
+            pos = 12 + (((section[10] & 0x0F) << 8) | section[11])
+            while pos + 5 <= section_end:
+                stream_type = section[pos]
+                if stream_type in TS_VIDEO_STREAM_TYPES:
+                    codecs.append(TS_VIDEO_STREAM_TYPES[stream_type])
+                elif stream_type in [0x1C, 0x20, 0x21, 0x42, 0xD1]:
+                    # Some other kind of video we can't name the way MediaInfo would
+                    return None
+                pos += 5 + (((section[pos + 3] & 0x0F) << 8) | section[pos + 4])
+            return ' / '.join(codecs) if codecs else None
+
+    return None
+
+def SniffHeader(path):
+    # Identify the container from the first few KB of the file. Returns a summary with just a General track, or None if
+    # we don't recognise the file and it needs a full MediaInfo parse.
+    with open(path, 'rb') as f:
+        data = bytearray(f.read(SNIFF_SIZE))
+
+    general = {'track_type' : 'General', 'file_extension' : os.path.splitext(path)[1].lstrip('.')}
+    try:
+        if data[:4] == bytearray('\x1a\x45\xdf\xa3'):
+            doc_type = SniffEBMLDocType(data)
+            if doc_type == 'matroska':
+                general['format'] = 'Matroska'
+            elif doc_type == 'webm':
+                general['format'] = 'WebM'
+            else:
+                return None
+        elif len(data) >= 188 * 3 and all(data[offset] == 0x47 for offset in range(0, min(len(data), 188 * 8), 188)):
+            general['format'] = 'MPEG-TS'
+            general['codecs_video'] = SniffTSVideoCodecs(data)
+        elif data[4:8] == bytearray('ftyp'):
+            general['format'] = 'QuickTime' if data[8:12] == bytearray('qt  ') else 'MPEG-4'
+        elif data[:4] == bytearray('\x00\x00\x01\xba'):
+            general['format'] = 'MPEG-PS'
+        else:
+            return None
+    except (ValueError, IndexError):
+        return None
+
+    # Older MediaInfo builds report the container under codec as well as format
+    general['codec'] = general['format']
+    return MediaSummary([dict((field, value) for field, value in general.iteritems() if value is not None)], partial=True)
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+# Every scanner and processor in a process shares one cache per database
+def GetProbeCache(config):
+    db_path = config.PROBE_CACHE_PATH if config.PROBE_CACHE else None
+    with _caches_lock:
+        if db_path not in _caches:
+            _caches[db_path] = ProbeCache(db_path)
+        return _caches[db_path]
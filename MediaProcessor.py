@@ -1,13 +1,15 @@
 #!/usr/bin/python
-import logging, os, shutil, subprocess, sys, tempfile, uuid, argparse, glob, time, functools, shlex
-import ConfigContainer
-from logging.handlers import RotatingFileHandler
+import logging, math, os, shutil, subprocess, sys, tempfile, uuid, argparse, glob, time, functools, shlex, collections, re, errno, threading
+import ConfigContainer, FileOps, MediaProbe, Metrics, LogConfig
 
 def exception_logger(function):
     @functools.wraps(function)
     def wrapper(*args, **kwargs):
+        # Tag everything logged in here with the processor's session
+        session = args[0].session_uuid if len(args) > 0 and isinstance(args[0], MediaProcessor) else None
         try:
-            return function(*args, **kwargs)
+            with LogConfig.Context(session=session):
+                return function(*args, **kwargs)
         except Exception, e:
             # Check to see if this is an instance of the MediaProcessor class
             if isinstance(args[0], MediaProcessor) and 'logged' not in vars(e):
@@ -24,53 +26,144 @@ def exception_logger(function):
 
     return wrapper
 
-class MediaProcessor(object):
-    def __init__(self, config_file):
+# Records the decorated method as a stage in the metrics, against the file it is given first
+def metered(stage):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(self, path, *args, **kwargs):
+            with self.metrics.stage(stage, path, self.session_uuid, lambda: self.MediaDuration(path)):
+                return function(self, path, *args, **kwargs)
+        return wrapper
+    return decorator
 
-        # Process the configuration file
-        self.config = ConfigContainer.ConfigContainer(config_file)
+# Raised by Call when a subscriber stopped the command early, rather than it failing on its own
+class CommandAborted(Exception):
+    pass
 
-        # Logging.
-        self.session_uuid = str(uuid.uuid4())
+# Raised by Call once the processor has been cancelled
+class Cancelled(CommandAborted):
+    pass
+
+# Live view of a running ffmpeg, fed from the key=value blocks it writes with -progress. Subscribers are called with
+# the Progress object at the end of every block, roughly twice a second.
+class Progress(object):
+    # Keys ffmpeg writes to -progress, so we can tell them apart from its log output on the same pipe
+    KEYS = ['frame', 'fps', 'bitrate', 'total_size', 'out_time_us', 'out_time_ms', 'out_time', 'dup_frames',
+            'drop_frames', 'speed', 'progress']
+    KEY_PATTERN = re.compile(r'^(stream_\d+_\d+_q|{})=(.*)$'.format('|'.join(KEYS)))
 
-        formatter = logging.Formatter('%%(asctime)-15s [MediaProcessor: %s] %%(message)s' % self.session_uuid[:6])
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.values = {}
+        self.started = time.time()
+        self.updated = None
+        self.subscribers = []
+        self.process = None
+        self.aborted = None
 
-        handler = RotatingFileHandler(self.config.LOG_FILE_PATH, mode='a', maxBytes=8 * 1024 * 1024, backupCount=2)
-        handler.setFormatter(formatter)
-        handler.setLevel(logging.INFO)
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
 
-        logger = logging.getLogger('')
-        logger.setLevel(logging.INFO)
-        logger.addHandler(handler)
+    def abort(self, reason):
+        # Stop the command; Call raises CommandAborted with the reason once it has exited
+        logging.info('[Progress] Stopping the command early: {}'.format(reason))
+        self.aborted = reason
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
 
-        if self.config.CONSOLE_LOGGING:
-            if len(logger.handlers) < 2:
-                console = logging.StreamHandler()
-                console.setLevel(logging.INFO)
-                formatter = logging.Formatter('%(message)s')
-                console.setFormatter(formatter)
-                logger.addHandler(console)
+    def feed(self, line):
+        # Returns whether the line was progress, rather than log output
+        match = self.KEY_PATTERN.match(line)
+        if match is None:
+            return False
+        self.values[match.group(1)] = match.group(2).strip()
+        if match.group(1) == 'progress':
+            self.updated = time.time()
+            for callback in self.subscribers:
+                callback(self)
+        return True
 
-        # If we're in a git repo, let's see if we can report our sha.
-        logging.info('Script was invoked from %s' % os.getcwd())
+    def number(self, key):
         try:
-            git_sha = subprocess.check_output('git rev-parse --short HEAD', shell=True)
-            if git_sha:
-                logging.info('Using version: %s' % git_sha.strip())
-        except: pass
+            return float(self.values.get(key, '').rstrip('x'))
+        except ValueError:
+            return None
+
+    @property
+    def frame(self):
+        return self.number('frame')
+
+    @property
+    def fps(self):
+        return self.number('fps')
+
+    @property
+    def speed(self):
+        return self.number('speed')
+
+    @property
+    def total_size(self):
+        return self.number('total_size')
+
+    @property
+    def out_time(self):
+        # Seconds of output written. Despite its name, out_time_ms is in microseconds too.
+        for key in ['out_time_us', 'out_time_ms']:
+            value = self.number(key)
+            if value is not None:
+                return value / 1000000.0
+        return None
+
+    @property
+    def finished(self):
+        return self.values.get('progress') == 'end'
+
+class MediaProcessor(object):
+    # Lines of a command's output we hold on to for the log when it fails
+    OUTPUT_TAIL_LINES = 200
+
+    # How much of a command's output we read at a time
+    READ_SIZE = 64 * 1024
+
+    # How often to log the progress of a long running ffmpeg
+    PROGRESS_LOG_INTERVAL = 60
+
+    # Room to leave for the Matroska cues per hour of video, ffmpeg suggests 50kB
+    INDEX_SPACE_PER_HOUR = 50 * 1024
+
+    # Hours of video to leave room for when we don't know how long the output will be
+    DEFAULT_INDEX_HOURS = 4
+
+    def __init__(self, config_file):
+
+        # Process the configuration file
+        self.config = ConfigContainer.ConfigContainer(config_file)
+        self.probe_cache = MediaProbe.GetProbeCache(self.config)
+        self.metrics = Metrics.GetRecorder(self.config)
+
+        # Logging.
+        self.session_uuid = str(uuid.uuid4())
+        LogConfig.Configure(self.config)
 
         # Create temp directory to use when processing files
         self.temp_dir = os.path.join(self.config.TEMP_ROOT, self.session_uuid)
         os.makedirs(self.temp_dir)
         self.keep_temp = False
 
+        # Commands running right now, so Cancel can stop them from another thread
+        self.active_lock = threading.Lock()
+        self.active = set()
+        self.cancelled = False
+
     def __del__(self):
-        if self.keep_temp or self.config.SAVE_ALWAYS:
-            logging.info("keep_temp or self.config.SAVE_ALWAYS set for this temp dir: {}".format(self.temp_dir))
-        else:
-            logging.info("Removing temp dir: {}".format(self.temp_dir))
-            shutil.rmtree(self.temp_dir)
+        with LogConfig.Context(session=self.session_uuid):
+            if self.keep_temp or self.config.SAVE_ALWAYS:
+                logging.info("keep_temp or self.config.SAVE_ALWAYS set for this temp dir: {}".format(self.temp_dir))
+            else:
+                logging.info("Removing temp dir: {}".format(self.temp_dir))
+                shutil.rmtree(self.temp_dir)
 
+    @metered('mkclean')
     @exception_logger
     def MKClean(self, path, output_path):
         logging.info('Running MKClean to remux and copy')
@@ -79,6 +172,7 @@ class MediaProcessor(object):
         self.Call(cmd)
         logging.info('Finished running MKClean')
 
+    @metered('overwrite')
     @exception_logger
     def SafeOverwrite(self, original_file, processed_file, lower_bound=.2, upper_bound=1.2, remux=True):
         logging.info('Starting safe overwrite, original file: {}, processed file: {}'.format(original_file, processed_file))
@@ -90,11 +184,21 @@ class MediaProcessor(object):
         logging.info('Lower bound on safe size: {}, Upper bound on safe size: {}'.format(self.SizeOfFormat(lower_bound), self.SizeOfFormat(upper_bound)))
 
         if upper_bound >= output_size and output_size >= lower_bound:
-            logging.info('Processed size falls within bounds, copying the output file into place: {} -> {}'.format(processed_file, original_file))
-            if remux and os.path.splitext(processed_file)[1] == '.mkv':
-                self.MKClean(processed_file, original_file)
-            else:
-                shutil.copy(processed_file, original_file)
+            logging.info('Processed size falls within bounds, moving the output file into place: {} -> {}'.format(processed_file, original_file))
+            # Build the new file up next to the original and swap it in with a rename, so the original is never
+            # half overwritten, and skip the copy altogether when the processed file is on the same filesystem
+            staging_path = FileOps.StagingPath(original_file)
+            try:
+                if remux and self.config.MKCLEAN_REMUX and os.path.splitext(processed_file)[1] == '.mkv':
+                    self.MKClean(processed_file, staging_path)
+                elif FileOps.SameFilesystem(processed_file, original_file):
+                    staging_path = processed_file
+                else:
+                    logging.info('Staged next to the original with a {}'.format(FileOps.CopyFile(processed_file, staging_path)))
+                FileOps.Install(staging_path, original_file)
+            finally:
+                if staging_path != processed_file and os.path.exists(staging_path):
+                    os.remove(staging_path)
             logging.info("Finished safe overwrite")
             return 0
         else:
@@ -102,29 +206,158 @@ class MediaProcessor(object):
             return 1
 
     @exception_logger
-    def Call(self, cmd):
-        # def shellquote(s):
-        #         return "'" + s.replace("'", "'\\''") + "'"
+    def Call(self, cmd, progress=None, line_handler=None):
+        # Stream the output rather than buffering all of it, so hours long encodes only cost us the last few lines.
+        # ffmpeg is asked to report its progress on the same pipe, which goes to progress instead of the log tail.
+        # line_handler, if given, sees every other line as it arrives.
+        cmd = list(cmd)
+        if self.config.FFMPEG_PATH in cmd:
+            position = cmd.index(self.config.FFMPEG_PATH) + 1
+            cmd[position:position] = ['-progress', 'pipe:1', '-nostats']
+            if progress is None:
+                progress = Progress(cmd)
+            progress.subscribe(self.LogProgress)
 
-        # logging.info("[Command] {}".format(" ".join(cmd)))
-        # stringified_cmd = ""
-        # for item in cmd:
-        #     if os.access(os.path.split(item)[0], os.F_OK):
-        #         #item = shlex.quote(item)
-        #         item = shellquote(item)
-        #     stringified_cmd += item + " "
+        logging.info("[Command] {}".format(" ".join(cmd)))
+        tail = collections.deque(maxlen=self.OUTPUT_TAIL_LINES)
 
-        # logging.info("[Command] Escaped version:  {}".format(stringified_cmd))
+        def handle(line):
+            if not line or (progress is not None and progress.feed(line)):
+                return
+            tail.append(line)
+            if line_handler is not None:
+                line_handler(line)
 
-        logging.info("[Command] {}".format(" ".join(cmd)))
+        started = time.time()
+        with self.active_lock:
+            if self.cancelled:
+                raise Cancelled('Not running {}, processing was cancelled'.format(cmd[0]))
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=0)
+            self.active.add(process)
+        if progress is not None:
+            progress.process = process
         try:
-            output = subprocess.check_output(cmd, stderr=subprocess.STDOUT) #, shell=True)
-        except Exception, e:
-            logging.error(e.output)
-            logging.info("[Command] return code: {}".format(e.returncode))
-            raise
+            pending = ''
+            while True:
+                block = os.read(process.stdout.fileno(), self.READ_SIZE)
+                if not block:
+                    break
+                # Progress meters from comskip and friends redraw the line with a bare carriage return
+                lines = re.split(r'\r\n|\r|\n', pending + block)
+                pending = lines.pop()
+                # Don't let output that never ends a line grow without bound
+                if len(pending) > self.READ_SIZE:
+                    lines.append(pending)
+                    pending = ''
+                for line in lines:
+                    handle(line)
+            handle(pending)
+        finally:
+            process.stdout.close()
+            returncode = self.Reap(process, cmd, started)
+            with self.active_lock:
+                self.active.discard(process)
+
+        output = '\n'.join(tail)
+        if self.cancelled:
+            raise Cancelled('{} was stopped, processing was cancelled'.format(cmd[0]))
+        if progress is not None and progress.aborted is not None:
+            raise CommandAborted(progress.aborted)
+        if returncode != 0:
+            logging.error(output)
+            logging.info("[Command] return code: {}".format(returncode))
+            raise subprocess.CalledProcessError(returncode, cmd, output)
 
         logging.info('[Command] Completed Successfully')
+        return output
+
+    def Cancel(self):
+        # Safe to call from any thread. Whatever is running is killed, and every Call from now on raises Cancelled,
+        # so the thread doing the processing unwinds and can clean up after itself.
+        with self.active_lock:
+            self.cancelled = True
+            processes = list(self.active)
+        logging.info('Cancelling processing, stopping {} running commands'.format(len(processes)))
+        for process in processes:
+            try:
+                process.kill()
+            except OSError:
+                # It already finished
+                pass
+
+    def Reap(self, process, cmd, started):
+        # Wait for the child ourselves, rather than through Popen, so we get its resource usage for the metrics. Its
+        # I/O counters are gone once it is reaped, so read those first.
+        bytes_read, bytes_written = Metrics.ReadProcessIO(process.pid)
+        while True:
+            try:
+                pid, status, rusage = os.wait4(process.pid, 0)
+                break
+            except OSError, e:
+                if e.errno != errno.EINTR:
+                    raise
+        process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        self.metrics.command(cmd, started, process.returncode, rusage, bytes_read, bytes_written)
+        return process.returncode
+
+    def MediaDuration(self, path):
+        # Seconds of media in the file, for working out how much faster than realtime a stage ran
+        durations = [float(track.duration) for track in self.probe_cache.parse(path).tracks if track.duration is not None]
+        return max(durations) / 1000.0 if durations else None
+
+    def MatroskaArgs(self, output_path, duration=None):
+        # Have ffmpeg write the cues at the front of the file, where players look for them, so it comes out ready to
+        # stream without an mkclean pass. If the cues outgrow the space ffmpeg just puts them at the end instead.
+        if os.path.splitext(output_path)[1] != '.mkv':
+            return []
+        hours = math.ceil(duration / 3600.0) + 1 if duration else self.DEFAULT_INDEX_HOURS
+        return ['-reserve_index_space', str(int(hours * self.INDEX_SPACE_PER_HOUR))]
+
+    def LogProgress(self, progress):
+        if progress.finished or time.time() - getattr(progress, 'logged', progress.started) >= self.PROGRESS_LOG_INTERVAL:
+            progress.logged = time.time()
+            logging.info('[Progress] frame {}, {} fps, speed {}x, {} s written, {}'.format(
+                progress.frame, progress.fps, progress.speed, progress.out_time,
+                self.SizeOfFormat(progress.total_size or 0)))
+
+    @exception_logger
+    def StartTime(self, path):
+        # First timestamp in the file; broadcast captures rarely start at zero
+        cmd = [self.config.FFPROBE_PATH, '-v', 'error', '-show_entries', 'format=start_time', '-of', 'csv=p=0', path]
+        try:
+            return float(self.Call(cmd).strip().splitlines()[-1])
+        except (ValueError, IndexError):
+            return 0.0
+
+    @exception_logger
+    def KeyframeIndex(self, path):
+        # Keyframe times of the first video stream in seconds from the start of the file. Building it is one
+        # packet-level pass over the file, so it is cached alongside the probe data.
+        return self.probe_cache.keyframes(path, self.ScanKeyframes)
+
+    @exception_logger
+    def ScanKeyframes(self, path):
+        logging.info('Building keyframe index for {}'.format(path))
+        cmd = [self.config.FFPROBE_PATH, '-v', 'error', '-select_streams', 'v:0', '-show_entries',
+               'format=start_time:packet=pts_time,flags', '-of', 'csv', path]
+        found = {'start_time' : 0.0, 'keyframes' : []}
+
+        # One line per packet, so parse them as they arrive instead of holding on to the lot
+        def parse(line):
+            fields = line.strip().split(',')
+            try:
+                if fields[0] == 'packet' and len(fields) >= 3 and 'K' in fields[2]:
+                    found['keyframes'].append(float(fields[1]))
+                elif fields[0] == 'format' and len(fields) >= 2:
+                    found['start_time'] = float(fields[1])
+            except ValueError:
+                # Packets without a timestamp report N/A
+                pass
+
+        self.Call(cmd, line_handler=parse)
+        keyframes = sorted(set(keyframe - found['start_time'] for keyframe in found['keyframes']))
+        logging.info('Found {} keyframes in {}'.format(len(keyframes), path))
+        return keyframes
 
     # Clean up after ourselves and exit.
     @exception_logger
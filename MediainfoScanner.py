@@ -4,24 +4,39 @@ from pymediainfo import MediaInfo
 
 class MediainfoScanner(Scanner.MediaScanner):
 
-    def __init__(self):
+    def __init__(self, probe_workers=1, full=False):
         # Call the super constructor
-        super(MediainfoScanner, self).__init__([self.print_media_info_rule], self.no_action, False)
+        super(MediainfoScanner, self).__init__([self.print_media_info_rule], self.no_action, False, probe_workers)
         self.pp = pprint.PrettyPrinter(indent = 4)
+        self.full = full
+
+    def probe_file(self, full_path):
+        # The probe cache only keeps the fields our rules use, go straight to MediaInfo if we want everything
+        if not self.full:
+            return super(MediainfoScanner, self).probe_file(full_path)
+
+        print("Scanning %s" % (full_path))
+        try:
+            return MediaInfo.parse(full_path)
+        except Exception as err:
+            print("Caught exception when probing %s, exception: %s" % (full_path, err))
+            return None
 
     def no_action(self, path, mediainfo):
         return
 
     def print_media_info_rule(self, mediainfo):
-        self.pp.pprint([vars(track) for track in mediainfo.tracks])
+        self.pp.pprint([track.to_data() for track in mediainfo.tracks])
         return
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--input', action="append", default=[], help='"One or more directories to scan.')
+    parser.add_argument("--probe-workers", type=int, default=1, help="Number of files to probe with MediaInfo concurrently")
+    parser.add_argument("--full", action='store_true', help="Print every field MediaInfo reports instead of the cached subset")
     args = parser.parse_args()
 
-    minfo = MediainfoScanner()
+    minfo = MediainfoScanner(args.probe_workers, args.full)
     minfo.scan(args.input)
 
     sys.exit(0)
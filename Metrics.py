@@ -0,0 +1,170 @@
+#!/usr/bin/python
+import argparse, collections, contextlib, datetime, json, os, sys, threading, time
+import ConfigContainer
+
+# Per stage timing and I/O records, one JSON object per line. Stages are the steps we care about (comskip, cutting,
+# transcoding, remuxing, overwriting, probing) and each command a stage runs gets a record of its own as well.
+
+def ReadProcessIO(pid):
+    # Bytes read and written by a child, including its own children. It has to be read before the child is reaped.
+    try:
+        with open('/proc/{}/io'.format(pid), 'r') as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+        return int(fields['rchar']), int(fields['wchar'])
+    except (IOError, KeyError, ValueError):
+        return None, None
+
+class Stage(object):
+    def __init__(self, name, path, session):
+        self.name = name
+        self.path = path
+        self.session = session
+        self.started = time.time()
+        self.cpu_user = 0.0
+        self.cpu_system = 0.0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.commands = 0
+        self.duration = None
+
+    def add_command(self, record):
+        self.commands += 1
+        self.cpu_user += record['cpu_user'] or 0.0
+        self.cpu_system += record['cpu_system'] or 0.0
+        self.bytes_read += record['bytes_read'] or 0
+        self.bytes_written += record['bytes_written'] or 0
+
+class MetricsRecorder(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def stages(self):
+        if not hasattr(self.local, 'stages'):
+            self.local.stages = []
+        return self.local.stages
+
+    @contextlib.contextmanager
+    def stage(self, name, path, session=None, duration=None):
+        # Commands run on this thread while the stage is open count towards it. duration is the seconds of media the
+        # stage works through, which may also be a function to work it out afterwards.
+        stage = Stage(name, path, session)
+        self.stages().append(stage)
+        status = 'failed'
+        try:
+            yield stage
+            status = 'ok'
+        finally:
+            self.stages().remove(stage)
+            # Stop the clock first, working out the duration may mean probing the file and that isn't the stage's time
+            wall = time.time() - stage.started
+            try:
+                stage.duration = duration() if callable(duration) else duration
+            except Exception:
+                stage.duration = None
+            self.write({'type' : 'stage', 'stage' : name, 'session' : session, 'file' : path, 'status' : status,
+                        'started' : stage.started, 'wall' : wall, 'cpu_user' : stage.cpu_user,
+                        'cpu_system' : stage.cpu_system, 'bytes_read' : stage.bytes_read,
+                        'bytes_written' : stage.bytes_written, 'commands' : stage.commands,
+                        'duration' : stage.duration, 'realtime' : stage.duration / wall if stage.duration and wall else None})
+
+    def command(self, cmd, started, returncode, rusage, bytes_read, bytes_written):
+        stages = self.stages()
+        record = {'type' : 'command', 'stage' : stages[-1].name if stages else None,
+                  'session' : stages[-1].session if stages else None, 'file' : stages[-1].path if stages else None,
+                  'command' : os.path.basename(next((arg for arg in cmd if arg != 'nice' and not arg.startswith('-')), cmd[0])),
+                  'status' : 'ok' if returncode == 0 else 'failed', 'started' : started, 'wall' : time.time() - started,
+                  'cpu_user' : rusage.ru_utime if rusage else None, 'cpu_system' : rusage.ru_stime if rusage else None,
+                  'bytes_read' : bytes_read, 'bytes_written' : bytes_written}
+        for stage in stages:
+            stage.add_command(record)
+        self.write(record)
+
+    def write(self, record):
+        line = json.dumps(record) + '\n'
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(line)
+
+# Stands in for a recorder when metrics are turned off
+class NullRecorder(object):
+    @contextlib.contextmanager
+    def stage(self, name, path, session=None, duration=None):
+        yield None
+
+    def command(self, cmd, started, returncode, rusage, bytes_read, bytes_written):
+        pass
+
+_recorders = {}
+_recorders_lock = threading.Lock()
+
+def GetRecorder(config):
+    with _recorders_lock:
+        if config.METRICS_PATH not in _recorders:
+            _recorders[config.METRICS_PATH] = MetricsRecorder(config.METRICS_PATH) if config.METRICS_PATH else NullRecorder()
+        return _recorders[config.METRICS_PATH]
+
+def ReadRecords(path):
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # A line cut short by a crash
+                pass
+
+def Summarise(path, top, days):
+    stages = [record for record in ReadRecords(path) if record.get('type') == 'stage']
+    if days:
+        since = time.time() - days * 86400
+        stages = [record for record in stages if record['started'] >= since]
+    if not stages:
+        print('No stage records in {}'.format(path))
+        return
+
+    print('Slowest stages:')
+    for record in sorted(stages, key=lambda record: record['wall'], reverse=True)[:top]:
+        print('  {:>9.1f}s  {:<12} {:>6}  {}'.format(record['wall'], record['stage'],
+              '{:.2f}x'.format(record['realtime']) if record.get('realtime') else '', record['file']))
+
+    print('\nTotals by stage:')
+    totals = collections.OrderedDict()
+    for record in sorted(stages, key=lambda record: record['stage']):
+        totals.setdefault(record['stage'], []).append(record)
+    for name, records in totals.iteritems():
+        wall = sum(record['wall'] for record in records)
+        cpu = sum(record['cpu_user'] + record['cpu_system'] for record in records)
+        moved = sum(record['bytes_read'] + record['bytes_written'] for record in records)
+        print('  {:<12} {:>5} runs  {:>10.1f}s wall  {:>10.1f}s cpu  {:>8.1f} MB/s  {} failed'.format(
+            name, len(records), wall, cpu, moved / wall / 1e6 if wall else 0,
+            len([record for record in records if record['status'] != 'ok'])))
+
+    print('\nRealtime factor by day:')
+    trend = collections.defaultdict(lambda: collections.defaultdict(list))
+    for record in stages:
+        if record.get('realtime'):
+            day = datetime.date.fromtimestamp(record['started']).isoformat()
+            trend[day][record['stage']].append(record['realtime'])
+    for day in sorted(trend):
+        print('  {}  {}'.format(day, '  '.join('{} {:.2f}x'.format(name, sum(factors) / len(factors))
+                                            for name, factors in sorted(trend[day].iteritems()))))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--path", help="Metrics file to read, defaults to metrics-path from scripts.conf")
+    parser.add_argument("--top", type=int, default=10, help="How many of the slowest stages to show")
+    parser.add_argument("--days", type=int, default=0, help="Only look at the last this many days (0 for everything)")
+    args = parser.parse_args()
+
+    path = args.path
+    if not path:
+        config_file_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'scripts.conf')
+        path = ConfigContainer.ConfigContainer(config_file_path).METRICS_PATH
+    if not path or not os.path.exists(path):
+        print('No metrics file to read, set metrics-path in scripts.conf')
+        sys.exit(1)
+
+    Summarise(path, args.top, args.days)
+    sys.exit(0)
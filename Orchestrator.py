@@ -0,0 +1,145 @@
+#!/usr/bin/python
+import argparse, contextlib, logging, os, signal, sys, threading
+import Comskip, Transcoder, ConfigContainer, JobQueue, LogConfig, postprocess
+
+# Runs many postprocess pipelines side by side in one process. Each pipeline gets its own processors, and so its own
+# temp dir, on a thread of its own. The steps that load up the machine share the job queue's per resource slots, so
+# however many recordings turn up at once, no more than the configured number of comskips or encodes run together.
+
+class PipelineRun(object):
+    def __init__(self, path, transcode, rename_ext, fused, pipelined):
+        self.path = path
+        self.transcode = transcode
+        self.rename_ext = rename_ext
+        self.fused = fused
+        self.pipelined = pipelined
+        self.status = None
+        self.error = None
+        self.cancelled = False
+        self.processors = []
+        self.done = threading.Event()
+
+    def wait(self, timeout=None):
+        self.done.wait(timeout)
+        return self.status
+
+class Orchestrator(object):
+    def __init__(self, max_pipelines):
+        self.config_file_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'scripts.conf')
+        self.config = ConfigContainer.ConfigContainer(self.config_file_path)
+        LogConfig.Configure(self.config)
+
+        self.pipelines = threading.BoundedSemaphore(max(1, max_pipelines))
+        self.slots = dict((resource, threading.BoundedSemaphore(max(1, self.config.JOB_SLOTS.get(resource, 1))))
+                          for resource in JobQueue.RESOURCES)
+        self.lock = threading.Lock()
+        self.runs = []
+
+    @contextlib.contextmanager
+    def slot(self, resource):
+        with self.slots[resource]:
+            yield
+
+    def submit(self, path, transcode=True, rename_ext=False, fused=False, pipelined=False):
+        run = PipelineRun(os.path.abspath(path), transcode, rename_ext, fused, pipelined)
+        with self.lock:
+            self.runs.append(run)
+        thread = threading.Thread(target=self.execute, args=(run,), name='Pipeline-' + os.path.basename(path))
+        thread.daemon = True
+        thread.start()
+        return run
+
+    def execute(self, run):
+        try:
+            with self.pipelines:
+                if run.cancelled:
+                    logging.info('{} was cancelled before it started'.format(run.path))
+                    run.status = 1
+                    return
+
+                comskip = Comskip.Comskip(self.config_file_path)
+                t = Transcoder.Transcoder(self.config_file_path) if run.transcode else None
+                with self.lock:
+                    run.processors = [processor for processor in [comskip, t] if processor is not None]
+                    # Cancelled while we were setting up
+                    if run.cancelled:
+                        for processor in run.processors:
+                            processor.Cancel()
+
+                logging.info('Starting pipeline for {}'.format(run.path))
+                try:
+                    run.status = postprocess.process_file(run.path, run.transcode, run.rename_ext, run.fused, run.pipelined,
+                                                          comskip=comskip, t=t, slot=self.slot)
+                except Exception, e:
+                    run.status = 1
+                    run.error = e
+                    if run.cancelled:
+                        logging.info('Pipeline for {} was cancelled'.format(run.path))
+                    else:
+                        logging.error('Pipeline for {} failed: {}'.format(run.path, e))
+                finally:
+                    # Don't leave half written intermediates behind in the temp dirs, unless a failure asked for them to
+                    # be kept for save-forensics
+                    for processor in run.processors:
+                        if run.status == 0 or run.cancelled or not processor.keep_temp:
+                            processor.Cleanup()
+                    with self.lock:
+                        run.processors = []
+                logging.info('Finished pipeline for {}, status {}'.format(run.path, run.status))
+        finally:
+            with self.lock:
+                self.runs.remove(run)
+            run.done.set()
+
+    def cancel(self, run):
+        with self.lock:
+            run.cancelled = True
+            processors = list(run.processors)
+        for processor in processors:
+            processor.Cancel()
+
+    def cancel_all(self):
+        with self.lock:
+            runs = list(self.runs)
+        for run in runs:
+            self.cancel(run)
+
+    def active(self):
+        with self.lock:
+            return list(self.runs)
+
+    def wait_all(self):
+        # Wait with a timeout so Ctrl+C still reaches us
+        while True:
+            runs = self.active()
+            if not runs:
+                return
+            runs[0].wait(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input_file", action="append", default=[], help="Files to process, all at once")
+    parser.add_argument("--transcode", action='store_true', help="Transcode the media into a nicer format")
+    parser.add_argument("--rename_ext", action='store_true', help="Rename the extension to match the new container")
+    parser.add_argument("--max-pipelines", type=int, default=4, help="How many files to work on at the same time")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--fused", action='store_true', help="Cut the commercials out during the transcode instead of in a separate pass")
+    mode.add_argument("--pipelined", action='store_true', help="Transcode while comskip runs, then cut the commercials out of the transcoded file")
+    args = parser.parse_args()
+
+    orchestrator = Orchestrator(args.max_pipelines)
+    runs = [orchestrator.submit(path, args.transcode, args.rename_ext, args.fused, args.pipelined) for path in args.input_file]
+
+    # Stop everything cleanly on Ctrl+C or a kill
+    def stop(signum, frame):
+        logging.info('Caught signal {}, cancelling every pipeline'.format(signum))
+        orchestrator.cancel_all()
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        orchestrator.wait_all()
+    except KeyboardInterrupt:
+        stop(signal.SIGINT, None)
+        orchestrator.wait_all()
+
+    sys.exit(1 if any(run.status != 0 for run in runs) else 0)
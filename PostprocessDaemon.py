@@ -0,0 +1,97 @@
+#!/usr/bin/python
+import argparse, logging, os, signal, socket, SocketServer, sys, threading
+import ConfigContainer, Orchestrator
+from RemoteTranscoder import SendMessage, ReadMessage
+
+# Stays up between recordings and takes postprocess jobs from postprocess_client.py over a Unix socket. The config,
+# logging and the orchestrator's concurrency limits are set up once, and a burst of recordings finishing together
+# queues up behind those limits instead of every one of them starting its own pipeline straight away.
+
+# How often a client waiting on its job hears that we are still working on it
+WAIT_INTERVAL = 30
+
+class DaemonHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        orchestrator = self.server.orchestrator
+        request = ReadMessage(self.rfile)
+        op = request.get('op')
+
+        if op == 'submit':
+            path = request.get('path')
+            if not path or not os.path.isfile(path):
+                SendMessage(self.wfile, {'error' : 'No such file: {}'.format(path)})
+                return
+
+            logging.info('[Daemon] Accepted {}'.format(path))
+            run = orchestrator.submit(path, request.get('transcode', False), request.get('rename_ext', False),
+                                      request.get('fused', False), request.get('pipelined', False))
+            if not request.get('wait', True):
+                SendMessage(self.wfile, {'queued' : True})
+                return
+
+            # Plex waits on the hook, so hold the connection open until the job is done
+            try:
+                while not run.done.is_set():
+                    run.wait(WAIT_INTERVAL)
+                    if not run.done.is_set():
+                        SendMessage(self.wfile, {'working' : True})
+                SendMessage(self.wfile, {'status' : run.status, 'error' : str(run.error) if run.error else None})
+            except socket.error:
+                logging.info('[Daemon] Client for {} went away, carrying on without it'.format(path))
+
+        elif op == 'status':
+            SendMessage(self.wfile, {'active' : [run.path for run in orchestrator.active()]})
+
+        elif op == 'cancel':
+            cancelled = []
+            for run in orchestrator.active():
+                if run.path == request.get('path'):
+                    orchestrator.cancel(run)
+                    cancelled.append(run.path)
+            SendMessage(self.wfile, {'cancelled' : cancelled})
+
+        else:
+            SendMessage(self.wfile, {'error' : 'Unknown request: {}'.format(op)})
+
+class PostprocessDaemon(object):
+    def __init__(self, socket_path=None, max_pipelines=None):
+        config_file_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'scripts.conf')
+        self.config = ConfigContainer.ConfigContainer(config_file_path)
+        self.socket_path = socket_path or self.config.DAEMON_SOCKET_PATH
+        self.orchestrator = Orchestrator.Orchestrator(max_pipelines or self.config.DAEMON_MAX_PIPELINES)
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        SocketServer.ThreadingUnixStreamServer.daemon_threads = True
+        self.server = SocketServer.ThreadingUnixStreamServer(self.socket_path, DaemonHandler)
+        self.server.orchestrator = self.orchestrator
+
+    def serve(self):
+        logging.info('[Daemon] Taking postprocess jobs on {}'.format(self.socket_path))
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+        return 0
+
+    def stop(self):
+        # Stop taking new work and cancel what is running; serve_forever has to be stopped from another thread
+        logging.info('[Daemon] Shutting down')
+        self.orchestrator.cancel_all()
+        threading.Thread(target=self.server.shutdown).start()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", help="Unix socket to listen on, defaults to socket-path from scripts.conf")
+    parser.add_argument("--max-pipelines", type=int, help="How many files to work on at the same time, defaults to max-pipelines from scripts.conf")
+    args = parser.parse_args()
+
+    daemon = PostprocessDaemon(args.socket, args.max_pipelines)
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: daemon.stop())
+    ret = daemon.serve()
+    daemon.orchestrator.wait_all()
+    sys.exit(ret)
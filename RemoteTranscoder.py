@@ -0,0 +1,290 @@
+#!/usr/bin/python
+import argparse, json, logging, os, Queue, shutil, socket, SocketServer, sys, threading, time
+import Transcoder
+
+# Size of the blocks we stream media files over the socket in
+BLOCK_SIZE = 1024 * 1024
+
+# How long a worker waits before asking again when there is no work
+RETRY_INTERVAL = 5
+
+# How many times a job is handed out before we give up on it
+MAX_ATTEMPTS = 3
+
+# A worker tells the coordinator it is still alive this often while it transcodes. A worker that loses power or its
+# network never closes the connection, so one we haven't heard from in HEARTBEAT_TIMEOUT seconds is taken as gone.
+HEARTBEAT_INTERVAL = 30
+HEARTBEAT_TIMEOUT = 3 * HEARTBEAT_INTERVAL
+
+# Addresses are either host:port or unix:/path/to/socket
+def ParseAddress(address):
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[len('unix:'):]
+    host, port = address.rsplit(':', 1)
+    return socket.AF_INET, (host, int(port))
+
+def SendMessage(wfile, message):
+    wfile.write(json.dumps(message) + '\n')
+    wfile.flush()
+
+def ReadMessage(rfile):
+    line = rfile.readline()
+    if not line:
+        raise socket.error('Connection closed')
+    return json.loads(line)
+
+def KeepAlive(sock):
+    # Let the kernel notice a peer that has vanished without a FIN, as a backstop to the heartbeats
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    sock.settimeout(HEARTBEAT_TIMEOUT)
+
+def SendFile(wfile, path):
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(BLOCK_SIZE)
+            if not block:
+                break
+            wfile.write(block)
+    wfile.flush()
+
+def ReceiveFile(rfile, path, size):
+    with open(path, 'wb') as f:
+        while size > 0:
+            block = rfile.read(min(BLOCK_SIZE, size))
+            if not block:
+                raise socket.error('Connection closed with {} bytes of {} left to read'.format(size, path))
+            f.write(block)
+            size -= len(block)
+
+class TranscodeJob(object):
+    def __init__(self, job_id, path, codec, crf, speed):
+        self.job_id = job_id
+        self.path = path
+        self.codec = codec
+        self.crf = crf
+        self.speed = speed
+        self.attempts = 0
+
+class CoordinatorHandler(SocketServer.StreamRequestHandler):
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        KeepAlive(self.connection)
+
+    def handle(self):
+        coordinator = self.server.coordinator
+        request = ReadMessage(self.rfile)
+        if request.get('op') != 'claim':
+            SendMessage(self.wfile, {'error' : 'Unknown request: {}'.format(request.get('op'))})
+            return
+
+        job = coordinator.claim()
+        if job is None:
+            SendMessage(self.wfile, {'job' : None, 'retry' : RETRY_INTERVAL})
+            return
+
+        # The job is ours for as long as this connection lives, if the worker goes away it goes back in the queue
+        worker = request.get('worker', 'unknown')
+        logging.info('[Coordinator] Handing {} to worker {}'.format(job.path, worker))
+        output_path = None
+        try:
+            send_input = not request.get('shared', False)
+            SendMessage(self.wfile, {'job' : job.job_id, 'path' : job.path, 'codec' : job.codec, 'crf' : job.crf,
+                                     'speed' : job.speed, 'size' : os.path.getsize(job.path) if send_input else 0})
+            if send_input:
+                SendFile(self.wfile, job.path)
+
+            # Heartbeats until the worker has a result for us, a read timing out means it is gone
+            result = ReadMessage(self.rfile)
+            while result.get('op') == 'heartbeat':
+                result = ReadMessage(self.rfile)
+            if result.get('status', 1) == 0:
+                output_path = os.path.join(coordinator.temp_dir, '{}-{}'.format(job.job_id, os.path.basename(result['name'])))
+                ReceiveFile(self.rfile, output_path, result['size'])
+            else:
+                logging.error('[Coordinator] Worker {} failed to transcode {}: {}'.format(worker, job.path, result.get('error')))
+            SendMessage(self.wfile, {'ok' : True})
+
+        except Exception, e:
+            logging.error('[Coordinator] Lost worker {} while it was working on {}: {}'.format(worker, job.path, e))
+            if output_path is not None and os.path.exists(output_path):
+                os.remove(output_path)
+            coordinator.release(job)
+            return
+
+        coordinator.complete(job, output_path, result.get('status', 1))
+
+class TranscodeCoordinator(object):
+    def __init__(self, address, temp_dir, on_complete):
+        self.address = address
+        self.temp_dir = temp_dir
+        self.on_complete = on_complete
+        self.jobs = Queue.Queue()
+        self.lock = threading.Lock()
+        self.outstanding = 0
+        self.idle = threading.Condition(self.lock)
+        self.next_id = 0
+
+        family, bind_address = ParseAddress(address)
+        if family == socket.AF_UNIX:
+            if os.path.exists(bind_address):
+                os.remove(bind_address)
+            server_class = SocketServer.ThreadingUnixStreamServer
+        else:
+            server_class = SocketServer.ThreadingTCPServer
+        server_class.allow_reuse_address = True
+        server_class.daemon_threads = True
+        self.server = server_class(bind_address, CoordinatorHandler)
+        self.server.coordinator = self
+        self.thread = None
+
+    def start(self):
+        logging.info('[Coordinator] Serving transcode jobs on {}'.format(self.address))
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        family, bind_address = ParseAddress(self.address)
+        if family == socket.AF_UNIX and os.path.exists(bind_address):
+            os.remove(bind_address)
+
+    def submit(self, path, codec, crf, speed):
+        with self.lock:
+            self.next_id += 1
+            self.outstanding += 1
+            job = TranscodeJob(self.next_id, path, codec, crf, speed)
+        logging.info('[Coordinator] Queued {} for a remote worker'.format(path))
+        self.jobs.put(job)
+
+    def claim(self):
+        try:
+            job = self.jobs.get_nowait()
+        except Queue.Empty:
+            return None
+        job.attempts += 1
+        return job
+
+    def release(self, job):
+        if job.attempts < MAX_ATTEMPTS:
+            self.jobs.put(job)
+        else:
+            logging.error('[Coordinator] Giving up on {} after {} attempts'.format(job.path, job.attempts))
+            self.complete(job, None, 1)
+
+    def complete(self, job, output_path, status):
+        try:
+            self.on_complete(job.path, output_path, status)
+        finally:
+            with self.lock:
+                self.outstanding -= 1
+                self.idle.notify_all()
+
+    def wait(self):
+        # Block until every job we were given has come back, one way or another
+        with self.lock:
+            while self.outstanding > 0:
+                self.idle.wait(RETRY_INTERVAL)
+
+class TranscodeWorker(object):
+    def __init__(self, address, shared=False, idle_exit=0):
+        self.address = address
+        self.shared = shared
+        self.idle_exit = idle_exit
+        self.name = '{}:{}'.format(socket.gethostname(), os.getpid())
+
+        # Get the configuration file
+        config_file_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'scripts.conf')
+
+        # Create transcoder object
+        self.transcoder = Transcoder.Transcoder(config_file_path)
+
+    def run(self):
+        idle_since = time.time()
+        while True:
+            try:
+                worked = self.work_one()
+            except socket.error, e:
+                logging.info('[Worker] Could not reach the coordinator at {}: {}'.format(self.address, e))
+                worked = False
+
+            if worked:
+                idle_since = time.time()
+            elif self.idle_exit and time.time() - idle_since > self.idle_exit:
+                logging.info('[Worker] No work for {} seconds, exiting'.format(self.idle_exit))
+                return 0
+            else:
+                time.sleep(RETRY_INTERVAL)
+
+    def work_one(self):
+        family, address = ParseAddress(self.address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        KeepAlive(sock)
+        sock.connect(address)
+        input_dir = None
+        try:
+            rfile = sock.makefile('rb')
+            wfile = sock.makefile('wb')
+
+            SendMessage(wfile, {'op' : 'claim', 'worker' : self.name, 'shared' : self.shared})
+            job = ReadMessage(rfile)
+            if job.get('job') is None:
+                return False
+
+            # Either read the input straight off shared storage or pull it over the connection. A fetched input goes in a
+            # directory of its own, an .mkv input would otherwise have the same name as the transcode of it.
+            if self.shared:
+                input_path = job['path']
+            else:
+                input_dir = os.path.join(self.transcoder.temp_dir, 'input')
+                os.makedirs(input_dir)
+                input_path = os.path.join(input_dir, os.path.basename(job['path']))
+                ReceiveFile(rfile, input_path, job['size'])
+
+            logging.info('[Worker] Transcoding {}'.format(job['path']))
+            stop_heartbeat = threading.Event()
+            heartbeat = threading.Thread(target=self.heartbeat, args=(wfile, job['job'], stop_heartbeat))
+            heartbeat.daemon = True
+            heartbeat.start()
+            try:
+                try:
+                    output_path = self.transcoder.Transcode(input_path, job['codec'], job['crf'], job['speed'])
+                finally:
+                    stop_heartbeat.set()
+                    heartbeat.join()
+                SendMessage(wfile, {'op' : 'result', 'job' : job['job'], 'status' : 0, 'name' : os.path.basename(output_path),
+                                    'size' : os.path.getsize(output_path)})
+                SendFile(wfile, output_path)
+            except socket.error:
+                raise
+            except Exception, e:
+                SendMessage(wfile, {'op' : 'result', 'job' : job['job'], 'status' : 1, 'error' : str(e)})
+
+            ReadMessage(rfile)
+            return True
+
+        finally:
+            sock.close()
+            if input_dir is not None:
+                shutil.rmtree(input_dir, ignore_errors=True)
+            self.transcoder.Cleanup()
+
+    def heartbeat(self, wfile, job_id, stop):
+        while not stop.wait(HEARTBEAT_INTERVAL):
+            try:
+                SendMessage(wfile, {'op' : 'heartbeat', 'job' : job_id})
+            except socket.error, e:
+                logging.info('[Worker] Lost the coordinator while transcoding: {}'.format(e))
+                return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--coordinator", required=True, help="Coordinator address to take jobs from, host:port or unix:/path")
+    parser.add_argument("--shared-storage", action='store_true', help="Read inputs straight from their paths instead of fetching them from the coordinator")
+    parser.add_argument("--idle-exit", type=int, default=0, help="Exit after this many seconds without work (0 keeps running)")
+    args = parser.parse_args()
+
+    worker = TranscodeWorker(args.coordinator, args.shared_storage, args.idle_exit)
+    sys.exit(worker.run())
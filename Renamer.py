@@ -3,9 +3,11 @@ import Scanner, MediaProcessor
 from pymediainfo import MediaInfo
 
 class RenameScanner(Scanner.MediaScanner):
-    def __init__(self, interactive):
+    JOB_NAME = 'rename'
+
+    def __init__(self, interactive, probe_workers=1):
         # Call the super constructor
-        super(RenameScanner, self).__init__([self.matroska_rule], self.rename_action, interactive)
+        super(RenameScanner, self).__init__([self.matroska_rule], self.rename_action, interactive, probe_workers)
 
     def rename_action(self, path, mediainfo):
         # Rename the file
@@ -14,9 +16,12 @@ class RenameScanner(Scanner.MediaScanner):
         try:
             print('Renaming {} to {}'.format(in_abs_path, out_abs_path))
             shutil.move(in_abs_path, out_abs_path)
+            return 0
         except Exception, e:
             print('Could not rename {} to {}, skipping...'.format(in_abs_path, out_abs_path))
+            return 1
 
+    @Scanner.header_rule('codec', 'file_extension')
     def matroska_rule(self, mediainfo):
         for track in mediainfo.tracks:
             if track.track_type == "General" and track.codec == 'Matroska' and track.file_extension != "mkv":
@@ -29,9 +34,14 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--input', action="append", default=[], help='"One or more directories to scan.')
     parser.add_argument("--interactive", action='store_true', help="Be prompted for each file that we want to comskip")
+    parser.add_argument("--watch", action='store_true', help="After the first scan, keep watching the input directories and process new recordings as they settle")
+    parser.add_argument("--probe-workers", type=int, default=1, help="Number of files to probe with MediaInfo concurrently")
     args = parser.parse_args()
 
-    renamer = RenameScanner(args.interactive)
-    renamer.scan(args.input)
+    renamer = RenameScanner(args.interactive, args.probe_workers)
+    if args.watch:
+        renamer.watch(args.input)
+    else:
+        renamer.scan(args.input)
 
     sys.exit(0)
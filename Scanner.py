@@ -1,65 +1,352 @@
 #!/usr/bin/python
-import os, subprocess, sys, argparse, pprint
-from pymediainfo import MediaInfo
+import os, subprocess, sys, argparse, pprint, collections, multiprocessing, threading, functools, uuid, time
+import ConfigContainer, MediaProbe, Lease, JobQueue, Metrics, LogConfig, Watcher
+from multiprocessing.pool import ThreadPool
+
+# os.scandir only exists on Python 3.5+, but the scandir package backports it
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+MEDIA_EXTENSIONS = ['mkv', 'mp4', 'ts', 'mpeg', 'mpg', 'webm', 'avi', 'ogg']
+
+# Marks a rule that can be settled from MediaProbe.SniffHeader's summary whenever the sniff found all of the given
+# fields on the General track
+def header_rule(*fields):
+    def decorator(rule):
+        rule.header_fields = fields
+        return rule
+    return decorator
 
 class MediaScanner(object):
-    def __init__(self, rules, action, interactive):
+    # How long a single probe may take before we give up on that file and move on
+    PROBE_TIMEOUT = 300
+
+    # What this scanner's jobs are called in the job queue, and which resource slots they run in
+    JOB_NAME = None
+    JOB_RESOURCE = 'remux'
+
+    def __init__(self, rules, action, interactive, probe_workers=1):
         self.pp = pprint.PrettyPrinter(indent=4)
         self.rules = rules
         self.action = action
         self.interactive = interactive
+        self.probe_workers = max(1, int(probe_workers))
 
-    def check_file(self, full_path):
-            print("Scanning %s" % (full_path))
-            try:
-                mediainfo = MediaInfo.parse(full_path)
+        # Get the configuration file
+        config_file_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'scripts.conf')
+        self.config = ConfigContainer.ConfigContainer(config_file_path)
+        LogConfig.Configure(self.config)
+
+        # Probes are shared with every other scanner and processor in this process
+        self.probe_cache = MediaProbe.GetProbeCache(self.config)
+        self.metrics = Metrics.GetRecorder(self.config)
+        self.session_uuid = str(uuid.uuid4())
 
-                for rule in self.rules:
-                    if rule(mediainfo):
-                        print("Matched rule for file {}".format(full_path))
+        # Claim each match before acting on it when other hosts may be scanning the same library
+        self.leases = Lease.GetLeaseManager(self.config)
+        self.local = threading.local()
 
-                        if self.interactive:
-                            skip = raw_input('Do you want to process {} [Y/N]'.format(full_path))
-                            if(len(skip) == 0 or skip[0].lower() == 'n'):
-                                break
+    @property
+    def lease(self):
+        # Per thread, job queue workers each hold their own
+        return getattr(self.local, 'lease', None)
 
-                        return mediainfo
+    @lease.setter
+    def lease(self, lease):
+        self.local.lease = lease
 
-            except Exception as err:
-                print("Caught exception when procesing %s, exception: %s" % (full_path, err))
+    def probe_file(self, full_path):
+        # This may run on a probe worker, so never let an exception escape; one bad file shouldn't take the pool down
+        print("Scanning %s" % (full_path))
+        try:
+            with self.metrics.stage('probe', full_path, self.session_uuid):
+                # A small read of the header is enough if it can settle every rule, otherwise do the full probe
+                summary = MediaProbe.SniffHeader(full_path)
+                if summary is not None and self.header_settles(summary):
+                    return summary
+                return self.probe_cache.parse(full_path)
+        except Exception as err:
+            print("Caught exception when probing %s, exception: %s" % (full_path, err))
+            return None
+
+    def header_settles(self, summary):
+        general = summary.tracks[0]
+        for rule in self.rules:
+            fields = getattr(rule, 'header_fields', None)
+            if fields is None or any(getattr(general, field) is None for field in fields):
+                return False
+        return len(self.rules) > 0
 
+    def match_rules(self, full_path, mediainfo):
+        if mediainfo is None:
             return None
 
+        try:
+            for rule in self.rules:
+                if rule(mediainfo):
+                    print("Matched rule for file {}".format(full_path))
+
+                    if self.interactive:
+                        skip = raw_input('Do you want to process {} [Y/N]'.format(full_path))
+                        if(len(skip) == 0 or skip[0].lower() == 'n'):
+                            break
+
+                    return mediainfo
+
+        except Exception as err:
+            print("Caught exception when procesing %s, exception: %s" % (full_path, err))
+
+        return None
+
+    def check_file(self, full_path):
+        return self.match_rules(full_path, self.probe_file(full_path))
+
+    def is_media_file(self, name):
+        return os.path.splitext(name)[1].lstrip('.') in MEDIA_EXTENSIONS
+
+    def walk_dir(self, path):
+        # Walk in sorted order so repeated scans process files in the same order
+        if scandir is None:
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for item in sorted(files):
+                    if self.is_media_file(item):
+                        yield os.path.join(root, item)
+            return
+
+        try:
+            entries = sorted(scandir(path), key=lambda entry: entry.name)
+        except OSError as err:
+            print("Could not list %s, exception: %s" % (path, err))
+            return
+
+        subdirs = []
+        for entry in entries:
+            if entry.is_dir():
+                # Like os.walk, don't descend into symlinked directories
+                if not entry.is_symlink():
+                    subdirs.append(entry.path)
+            elif self.is_media_file(entry.name):
+                yield entry.path
+
+        for subdir in subdirs:
+            for full_path in self.walk_dir(subdir):
+                yield full_path
+
+    def find_files(self, path_list):
+        for path in path_list:
+            if (os.path.isdir(path)):
+                for full_path in self.walk_dir(path):
+                    yield full_path
+            else:
+                yield os.path.abspath(path)
+
+    def probe_files(self, candidates):
+        # Probe one file at a time unless we were asked for a worker pool
+        if self.probe_workers == 1:
+            for full_path in candidates:
+                yield full_path, self.probe_file(full_path)
+            return
+
+        # Keep a bounded window of outstanding probes and hand back results in submission order, so the rules and
+        # actions run in the same order as they would have sequentially
+        pool = ThreadPool(self.probe_workers)
+        pending = collections.deque()
+        try:
+            for full_path in candidates:
+                pending.append((full_path, pool.apply_async(self.probe_file, (full_path,))))
+                if len(pending) >= self.probe_workers * 2:
+                    yield self.collect_probe(*pending.popleft())
+            while pending:
+                yield self.collect_probe(*pending.popleft())
+        finally:
+            # Don't join; a probe that is wedged in libmediainfo would hang us here forever
+            pool.terminate()
+
+    def collect_probe(self, full_path, result):
+        try:
+            return full_path, result.get(self.PROBE_TIMEOUT)
+        except multiprocessing.TimeoutError:
+            print("Timed out probing %s after %s seconds, skipping" % (full_path, self.PROBE_TIMEOUT))
+        except Exception as err:
+            print("Caught exception when probing %s, exception: %s" % (full_path, err))
+        return full_path, None
+
     def scan(self, path_list):
         if isinstance(path_list, basestring):
             path_list = [path_list]
         elif(len(path_list) == 0):
             print("No directories specified for processing, exiting...")
 
-        files_to_transcode = {}
-        for path in path_list:
-            if (os.path.isdir(path)):
-                for root, dirs, files in os.walk(path):
-                    for item in files:
-                        name, ext = os.path.splitext(item)
-                        if (ext.lstrip('.') in ['mkv', 'mp4', 'ts', 'mpeg', 'mpg', 'webm', 'avi', 'ogg']):
-                            full_path = os.path.join(root, item)
-                            info = self.check_file(full_path)
-                            if info is not None:
-                                print("Adding {} to list of files to be processed...".format(full_path))
-                                files_to_transcode[full_path] = info
-            else:
-                full_path = os.path.abspath(path)
-                info = self.check_file(full_path)
-                if info is not None:
-                    print("Adding {} to list of files to be processed...".format(full_path))
-                    files_to_transcode[full_path] = info
+        if self.config.JOB_QUEUE:
+            return self.scan_queued(path_list)
+
+        # The walk feeds the probes, which feed the rules, which feed the actions, so the first match starts processing
+        # straight away and we never hold more than the probe window in memory
+        processed = []
+        for full_path, info in self.find_matches(path_list):
+            if self.leases is not None:
+                self.lease = self.leases.acquire(full_path)
+                if self.lease is None:
+                    print('Another host is already processing %s, skipping' % full_path)
+                    continue
+
+                # Whoever held it before us may have finished with it since we probed it
+                info = self.recheck(full_path, info)
+                if info is None:
+                    print('%s no longer needs processing, skipping' % full_path)
+                    self.release_lease()
+                    continue
+
+            try:
+                print('Started processing %s' % full_path)
+                self.action(full_path, info)
+                print('Finished processing %s' % full_path)
+                processed.append(os.path.basename(full_path))
+            finally:
+                self.release_lease()
+
+        self.pp.pprint(processed)
+
+        return 0
+
+    def watch(self, path_list):
+        if isinstance(path_list, basestring):
+            path_list = [path_list]
+
+        # Start watching before catching up on whatever turned up while we weren't, the catch up can take hours and
+        # anything that lands in the meantime queues up for afterwards
+        watcher = Watcher.GetWatcher(path_list, self.config.WATCH_POLL_INTERVAL)
+        self.scan(path_list)
+        print("Watching %s for new recordings" % ", ".join(path_list))
+
+        # Files we've seen change, with their size and mtime and when those last moved. Recordings and copies grow for
+        # a while, so only go near a file once it has sat still for watch-settle seconds.
+        pending = {}
+        while True:
+            for full_path in watcher.changes(min(self.config.WATCH_SETTLE, 5)):
+                if self.is_media_file(os.path.basename(full_path)):
+                    pending.setdefault(full_path, (None, None))
+
+            now = time.time()
+            settled = []
+            for full_path, (key, since) in pending.items():
+                try:
+                    st = os.stat(full_path)
+                except OSError:
+                    # Gone again, a temp file or a rename
+                    del pending[full_path]
+                    continue
+                if (st.st_size, st.st_mtime) != key:
+                    pending[full_path] = ((st.st_size, st.st_mtime), now)
+                elif now - since >= self.config.WATCH_SETTLE:
+                    settled.append(full_path)
+                    del pending[full_path]
+
+            if settled:
+                self.scan(sorted(settled))
+
+    def scan_queued(self, path_list):
+        queue = JobQueue.GetJobQueue(self.config)
+        handlers = {}
+        for name, resource, rules, action in self.job_stages():
+            handlers[name] = (resource, functools.partial(self.run_job, rules, action))
 
-        self.pp.pprint([os.path.basename(path) for path in files_to_transcode.keys()])
+        # Start working straight away, on whatever an earlier scan left behind as well as on new matches
+        runner = JobQueue.JobRunner(queue, handlers, self.config.JOB_SLOTS)
+        runner.start()
+        try:
+            for full_path, info in self.find_matches(path_list):
+                for name in self.queued_stages(info):
+                    queue.submit(full_path, name, handlers[name][0])
+        finally:
+            runner.join()
 
-        for item in files_to_transcode.keys():
-            print('Started processing %s' % item)
-            self.action(item, files_to_transcode[item])
-            print('Finished processing %s' % item)
+        self.pp.pprint([(os.path.basename(path), name, state) for job_id, path, name, resource, state, attempts, error
+                        in queue.jobs() if name in handlers and state == 'failed'])
 
         return 0
+
+    def job_stages(self):
+        # (name, resource, rules, action) for every kind of job this scanner queues
+        return [(self.JOB_NAME, self.job_resource(), self.rules, self.action)]
+
+    def job_resource(self):
+        return self.JOB_RESOURCE
+
+    def queued_stages(self, info):
+        return [self.JOB_NAME]
+
+    def current_path(self, path):
+        # A transcode moves the file to .mkv when it is done
+        if not os.path.exists(path) and os.path.exists(os.path.splitext(path)[0] + '.mkv'):
+            return os.path.splitext(path)[0] + '.mkv'
+        return path
+
+    def run_job(self, rules, action, path):
+        path = self.current_path(path)
+        if not os.path.exists(path):
+            print('%s is gone, nothing to do' % path)
+            return 0
+
+        if self.leases is not None:
+            self.lease = self.leases.acquire(path)
+            if self.lease is None:
+                # Retried later, by when the other host will be done and the rules will say so
+                print('Another host is already processing %s, will try again later' % path)
+                return 1
+
+        try:
+            # The job may have sat in the queue a while, or been resumed after a crash part way through, so judge the
+            # file as it is now
+            mediainfo = self.probe_file(path)
+            if mediainfo is None:
+                return 1
+            if not any(rule(mediainfo) for rule in rules):
+                print('%s no longer needs processing' % path)
+                return 0
+
+            print('Started processing %s' % path)
+            status = action(path, mediainfo)
+            print('Finished processing %s' % path)
+            return status or 0
+        finally:
+            self.release_lease()
+
+    def recheck(self, full_path, info):
+        if not os.path.exists(full_path):
+            return None
+
+        # The probe cache only re-parses the file if it actually changed
+        mediainfo = self.probe_file(full_path)
+        try:
+            if mediainfo is not None and any(rule(mediainfo) for rule in self.rules):
+                return mediainfo
+        except Exception as err:
+            print("Caught exception when procesing %s, exception: %s" % (full_path, err))
+        return None
+
+    def take_lease(self):
+        # For actions that finish in the background; they release the lease themselves when they are done
+        lease, self.lease = self.lease, None
+        return lease
+
+    def lease_lost(self):
+        # Whatever the action was doing, it mustn't write the file back once another host has claimed it
+        return self.lease is not None and self.lease.lost
+
+    def release_lease(self):
+        if self.lease is not None:
+            self.lease.release()
+            self.lease = None
+
+    def find_matches(self, path_list):
+        for full_path, mediainfo in self.probe_files(self.find_files(path_list)):
+            info = self.match_rules(full_path, mediainfo)
+            if info is not None:
+                yield full_path, info
@@ -1,17 +1,66 @@
-import argparse, os, uuid, tempfile, shutil, subprocess, glob, sys, logging
-import ConfigContainer, Scanner, MediaProcessor
-from pymediainfo import MediaInfo
+import argparse, os, uuid, tempfile, shutil, subprocess, glob, sys, logging, multiprocessing, threading
+import Capabilities, ConfigContainer, Scanner, MediaProcessor, RemoteTranscoder, JobQueue
+from multiprocessing.pool import ThreadPool
+
+# Bounds SafeOverwrite puts on the transcoded size, relative to the input, unless the caller passes its own as the
+# size_bounds option
+DEFAULT_SIZE_BOUNDS = (.2, 1.2)
+
+# Subscribes to an encode's progress and projects its final size from what it has written so far. Once the projection
+# has been outside the bounds for a few checks in a row, there's no point finishing an encode we will only throw away.
+class SizeProjection(object):
+    def __init__(self, config, duration, input_size, size_bounds):
+        self.config = config
+        self.duration = duration
+        self.lower_bound = size_bounds[0] * input_size
+        self.upper_bound = size_bounds[1] * input_size
+        self.checked = 0
+        self.strikes = 0
+
+    def __call__(self, progress):
+        out_time = progress.out_time
+        if progress.finished or not out_time or not progress.total_size:
+            return
+        # The first few minutes, with the titles and the easy to encode black frames, say little about the rest
+        if out_time < self.duration * self.config.EARLY_ABORT_MIN_PROGRESS:
+            return
+        if progress.updated - self.checked < self.config.EARLY_ABORT_INTERVAL:
+            return
+        self.checked = progress.updated
+
+        projected = progress.total_size / out_time * self.duration
+        if self.lower_bound <= projected <= self.upper_bound:
+            self.strikes = 0
+            return
+
+        self.strikes += 1
+        logging.info('Encode is projected to end up at {:.0f} bytes, outside {:.0f} - {:.0f} ({} of {} checks)'.format(
+            projected, self.lower_bound, self.upper_bound, self.strikes, self.config.EARLY_ABORT_WINDOW))
+        if self.strikes >= self.config.EARLY_ABORT_WINDOW:
+            progress.abort('projected output size {:.0f} bytes is outside the safe overwrite bounds'.format(projected))
 
 class Transcoder(MediaProcessor.MediaProcessor):
     @MediaProcessor.exception_logger
     def BuildFFMPEGCommands(self, path, mediainfo, codec, crf, speed, options=None):
         basename = os.path.basename(path)
-        temp_file = os.path.join(self.temp_dir, os.path.splitext(basename)[0] + '.mkv')
+        options = dict(options) if options else {}
+        temp_file = options.get('output_path', os.path.join(self.temp_dir, os.path.splitext(basename)[0] + '.mkv'))
+
+        # Cutting segments out during the encode needs the frames in system memory for the select filters
+        segments = options.get('segments')
+        if segments is not None:
+            if codec in ['copy', 'none']:
+                raise Exception("Can't cut segments out of the video while stream copying it")
+            options['disable_hw_decode'] = True
 
         # Setup our ffmpeg command
-        base_cmd = ['nice', '-n20', self.config.FFMPEG_PATH, '-y'] + self.SelectDecodeCommand(mediainfo, codec, options=options) + [path]
+        seek_cmd = ['-ss', options['input_seek']] if 'input_seek' in options else []
+        base_cmd = ['nice', '-n20', self.config.FFMPEG_PATH, '-y'] + seek_cmd + self.SelectDecodeCommand(mediainfo, codec, options=options) + [path]
         in_filter_graph = []
-        map_cmd = ['-map', '0:v', '-map', '0:a', '-c', 'copy']
+        if options.get('video_only', False):
+            map_cmd = ['-map', '0:v', '-c', 'copy']
+        else:
+            map_cmd = ['-map', '0:v', '-map', '0:a', '-c', 'copy']
         encode_cmd = self.SelectEncodeCommand(mediainfo, codec, crf, speed, options=options)
         interlace_cmd = []
         out_filter_graph = []
@@ -37,7 +86,7 @@ class Transcoder(MediaProcessor.MediaProcessor):
             if(len(in_filter_graph) == 0):
                 in_filter_graph.extend(['-vf', 'format=' + options['pix_fmt']])
             else:
-                in_filter_graph[-1].append(',format=' + options['pix_fmt'])
+                in_filter_graph[-1] += ',format=' + options['pix_fmt']
 
         # Analyze the media to determine what other processing we need to do
         for track in mediainfo.tracks:
@@ -63,21 +112,75 @@ class Transcoder(MediaProcessor.MediaProcessor):
                     map_cmd[1] = '[v]'
                     logging.info("Burning default or forced subtitles in. Stream ID: %s, Language: %s, Default: %s, Forced: %s, Format: %s" % (track.stream_identifier, track.language, track.default, track.forced, track.format))
 
+        # Keep only the wanted segments as part of this encode, instead of cutting them out in a pass of their own
+        if segments is not None:
+            video_filters = in_filter_graph[1:] + interlace_cmd[1:] + self.SegmentSelectFilters(segments, 'v')
+            if len(out_filter_graph) > 0:
+                out_filter_graph[1] = out_filter_graph[1].replace('overlay[v]', 'overlay,' + ','.join(video_filters) + '[v]')
+                in_filter_graph = []
+            else:
+                in_filter_graph = ['-vf', ','.join(video_filters)]
+            interlace_cmd = []
+            encode_cmd = encode_cmd + ['-af', ','.join(self.SegmentSelectFilters(segments, 'a'))] + self.SelectAudioEncodeCommand(mediainfo)
+
+            # Subtitles can't go through the select filter, so they would no longer line up
+            if len(sub_cmd) > 0:
+                logging.info("Dropping subtitle streams, they can't be cut along with the segments")
+                sub_cmd = []
+
+        # The caller muxes the audio and subtitles back in itself
+        if options.get('video_only', False):
+            sub_cmd = []
+
+        # Bring the subtitles we keep over in the encode itself, rather than remuxing them in with a pass of their own
+        two_pass_subs = len(sub_cmd) > 0 and options.get('two_pass_subs', False)
+        if len(sub_cmd) > 0 and not two_pass_subs:
+            map_cmd = map_cmd[:4] + ['-map', '0:s'] + sub_cmd + map_cmd[4:]
+            # The subtitles burned in stay as a stream as well, just like they did with the remux
+            out_filter_graph = out_filter_graph[:2]
+
         # Build the full command
-        cmd = base_cmd + in_filter_graph + map_cmd + interlace_cmd + encode_cmd + out_filter_graph + [temp_file]
+        cmd = base_cmd + in_filter_graph + map_cmd + interlace_cmd + encode_cmd + out_filter_graph
+        cmd += self.MatroskaArgs(temp_file, self.ExpectedDuration(mediainfo, options)) + [temp_file]
 
         # Add the transcode command to the list of commands to run
         cmds = [cmd]
 
         # Add the sub command to the list of commands to run
-        if len(sub_cmd) > 0:
+        if two_pass_subs:
             cmds[0][-1] = os.path.splitext(temp_file)[0] + '_pre_subs.mkv'
-            cmds.append(base_cmd + ['-i', cmds[0][-1], '-map', '1:v', '-map', '1:a', '-map', '0:s', '-c', 'copy'] + sub_cmd + [temp_file])
+            cmds.append(base_cmd + ['-i', cmds[0][-1], '-map', '1:v', '-map', '1:a', '-map', '0:s', '-c', 'copy'] + sub_cmd +
+                        self.MatroskaArgs(temp_file, self.ExpectedDuration(mediainfo, options)) + [temp_file])
             logging.info("Subtitle command {}".format(cmds[-1]))
 
         print("Commands: {}".format(cmds))
         return cmds
 
+    @MediaProcessor.exception_logger
+    def SegmentSelectFilters(self, segments, media_type):
+        # Select only the frames that fall in one of the segments, and close up the gaps they leave behind
+        ranges = []
+        for start, end in segments:
+            if end == -1:
+                ranges.append('gte(t,{:.3f})'.format(start))
+            elif end > start:
+                ranges.append('between(t,{:.3f},{:.3f})'.format(start, end))
+
+        if media_type == 'v':
+            return ["select='{}'".format('+'.join(ranges)), 'setpts=N/FRAME_RATE/TB']
+        return ["aselect='{}'".format('+'.join(ranges)), 'asetpts=N/SR/TB']
+
+    @MediaProcessor.exception_logger
+    def SelectAudioEncodeCommand(self, mediainfo):
+        # Filtered audio can't be stream copied, so re-encode it as close to the original as we can
+        for track in mediainfo.tracks:
+            if track.track_type == "Audio":
+                encoder = {'AC-3' : 'ac3', 'E-AC-3' : 'eac3'}.get(track.format, 'aac')
+                if track.bit_rate is not None:
+                    return ['-c:a', encoder, '-b:a', str(track.bit_rate)]
+                return ['-c:a', encoder]
+        return ['-c:a', 'aac']
+
     @MediaProcessor.exception_logger
     def SelectEncodeCommand(self, mediainfo, codec, crf, speed, options=None):
         # Build the actual encoding command
@@ -123,11 +226,18 @@ class Transcoder(MediaProcessor.MediaProcessor):
 
         elif codec == 'x265' or codec == 'x264':
             encode_cmd = ['-c:v', 'lib' + codec, '-preset', speed, '-crf', crf]
-            if 'tune' in options:
+            if options and 'tune' in options:
                 encode_cmd.extend(['-tune', options['tune']])
+            # Keep to our thread budget when we are one of several encodes running side by side
+            if options and 'threads' in options:
+                if codec == 'x265':
+                    encode_cmd.extend(['-x265-params', 'pools={}'.format(options['threads'])])
+                else:
+                    encode_cmd.extend(['-threads', str(options['threads'])])
 
         elif codec == 'vp9':
-            encode_cmd = ['-c:v', 'libvpx-vp9', '-threads', '12', '-deadline', 'good', '-cpu-used', '1', '-crf', crf, '-b:v', '0'] # '-row-mt', '1'
+            threads = str(options['threads']) if options and 'threads' in options else str(multiprocessing.cpu_count())
+            encode_cmd = ['-c:v', 'libvpx-vp9', '-threads', threads, '-row-mt', '1', '-deadline', 'good', '-cpu-used', '1', '-crf', crf, '-b:v', '0']
             logging.info("Currently ignoring the speed parameter for VP9 - using 'Good', and -cpu-used 1")
 
         else:
@@ -165,7 +275,10 @@ class Transcoder(MediaProcessor.MediaProcessor):
                     logging.info('Couldn\'t find a decoder for the given track: %s' % e)
                 break
 
-        if 'decoder' in locals():
+        if 'decoder' in locals() and not Capabilities.GetCapabilities(self.config).decoder(decoder):
+            logging.info('Hardware decoder {} does not work on this host, using software decoding'.format(decoder))
+            return ['-i']
+        elif 'decoder' in locals():
             logging.info('Using hardware decoder {} for this content'.format(decoder))
             return ['-hwaccel', 'cuvid', '-c:v', decoder, '-i']
         else:
@@ -174,7 +287,8 @@ class Transcoder(MediaProcessor.MediaProcessor):
 
     @MediaProcessor.exception_logger
     def AutoSelectEncParameters(self, mediainfo, options=None):
-        if self.config.NVENC_SUPPORT and not (options and options.get('disable_hw_encode', False)):
+        if self.config.NVENC_SUPPORT and not (options and options.get('disable_hw_encode', False)) and \
+                Capabilities.GetCapabilities(self.config).encoder('hevc_nvenc'):
             params = {'codec': 'hevc_nvenc', 'crf' : '23', 'speed' : 'hq'}
         else:
             # Default parameters
@@ -193,15 +307,17 @@ class Transcoder(MediaProcessor.MediaProcessor):
         logging.info("Auto-codec selection: codec {}, crf {}, speed {}".format(params['codec'], params['crf'], params['speed']))
         return params
 
+    @MediaProcessor.metered('transcode')
     @MediaProcessor.exception_logger
-    def Transcode(self, path, codec, crf, speed, options=None):
+    def Transcode(self, path, codec, crf, speed, options=None, mediainfo=None):
         if not os.path.isfile(path):
             logging.error('Path does not point to a file: {}'.format(path))
 
         logging.info('Transcode processing starting for %s' % path)
 
-        # Get the media info object for this file
-        mediainfo = MediaInfo.parse(path)
+        # Get the media info object for this file, unless the caller already fully probed it
+        if mediainfo is None or getattr(mediainfo, 'partial', False):
+            mediainfo = self.probe_cache.parse(path)
 
         # Handle auto-selecting parameters
         if codec == 'auto':
@@ -210,24 +326,37 @@ class Transcoder(MediaProcessor.MediaProcessor):
             speed = params['speed']
             crf = params['crf']
 
-        try:
-            # Full hardware transcode
+        # A single software encode can't keep every core busy, so split long files up and encode the pieces side by side
+        if codec in ['x265', 'x264', 'vp9'] and self.config.CHUNK_WORKERS > 1 and not (options and \
+                ('segments' in options or 'start_timestamp' in options or 'duration' in options)):
             try:
-                cmds = self.BuildFFMPEGCommands(path, mediainfo, codec, crf, speed, options=options)
-                logging.info ('Transcoder command builder returned {} commands to run'.format(len(cmds)))
-                for cmd in cmds:
-                    self.Call(cmd)
-
+                return self.ChunkedTranscode(path, mediainfo, codec, crf, speed, options=options)
             except Exception, e:
-                logging.info('Full hardware transcoding failed, trying software decode, hardware encode: %s' % e)
-                # Software decode, hardware transcode
-                hw_dec_disabled = {'disable_hw_decode' : True}
-                if options:
-                    hw_dec_disabled.update(options)
-                cmds = self.BuildFFMPEGCommands(path, mediainfo, codec, crf, speed, options=hw_dec_disabled)
+                logging.info('Chunked transcoding failed, falling back to a single encode: %s' % e)
+
+        try:
+            # The decoder and encoder have been checked on this host already, so only fall back on what this file turns
+            # out not to like, instead of running the whole encode again on the off chance
+            attempt_options = dict(options) if options else {}
+            while True:
+                cmds = self.BuildFFMPEGCommands(path, mediainfo, codec, crf, speed, options=attempt_options)
                 logging.info ('Transcoder command builder returned {} commands to run'.format(len(cmds)))
-                for cmd in cmds:
-                    self.Call(cmd)
+                try:
+                    self.RunEncodeCommands(cmds, path, mediainfo, options)
+                    break
+                except MediaProcessor.CommandAborted:
+                    # Decoding or muxing another way won't change the size it was heading for
+                    raise
+                except Exception, e:
+                    if '-hwaccel' in cmds[0]:
+                        logging.info('Hardware decoding failed on this file, trying software decode: %s' % e)
+                        attempt_options['disable_hw_decode'] = True
+                    elif '0:s' in cmds[0]:
+                        # Some subtitle streams won't map straight across, so remux them in afterwards
+                        logging.info('Transcoding with the subtitles failed, trying again with a separate subtitle pass: %s' % e)
+                        attempt_options['two_pass_subs'] = True
+                    else:
+                        raise
 
             # Return the transcoded file
             temp_path = cmds[-1][-1]
@@ -238,10 +367,124 @@ class Transcoder(MediaProcessor.MediaProcessor):
             self.Error('Something went wrong during transcoding: %s' % e)
             raise
 
+    @MediaProcessor.exception_logger
+    def RunEncodeCommands(self, cmds, path, mediainfo, options=None):
+        # The first command is the encode, anything after it is a quick remux of its output
+        for i, cmd in enumerate(cmds):
+            progress = None
+            if i == 0 and self.config.EARLY_ABORT and self.WillOverwrite(options):
+                duration = self.ExpectedDuration(mediainfo, options)
+                if duration:
+                    progress = MediaProcessor.Progress(cmd)
+                    progress.subscribe(SizeProjection(self.config, duration, os.path.getsize(path),
+                                                      (options or {}).get('size_bounds', DEFAULT_SIZE_BOUNDS)))
+            self.Call(cmd, progress=progress)
+
+    def WillOverwrite(self, options=None):
+        # The bounds only mean something for an encode that SafeOverwrite will judge against the whole input, not for
+        # a sample of part of it like the quality tests take
+        options = options or {}
+        return 'size_bounds' in options or not ('start_timestamp' in options or 'duration' in options)
+
+    @MediaProcessor.exception_logger
+    def ExpectedDuration(self, mediainfo, options=None):
+        # Seconds of video the encode will write, or None if we can't tell
+        options = options or {}
+        durations = [float(track.duration) for track in mediainfo.tracks if track.duration is not None]
+        media_duration = max(durations) / 1000.0 if durations else None
+
+        if options.get('segments') is not None:
+            total = 0.0
+            for start, end in options['segments']:
+                # The last segment runs to the end of the file
+                if end == -1:
+                    if media_duration is None:
+                        return None
+                    end = media_duration
+                if end > start:
+                    total += end - start
+            return total or None
+        if 'duration' in options:
+            try:
+                return float(options['duration'])
+            except ValueError:
+                return None
+        if 'start_timestamp' in options:
+            return None
+
+        return media_duration
+
+    @MediaProcessor.exception_logger
+    def ChunkBoundaries(self, path):
+        # Split on keyframes, which broadcast encoders also place at scene cuts, every chunk-length seconds or so
+        keyframes = self.KeyframeIndex(path)
+        boundaries = [0.0]
+        for keyframe in keyframes:
+            if keyframe - boundaries[-1] >= self.config.CHUNK_LENGTH:
+                boundaries.append(keyframe)
+        return boundaries
+
+    @MediaProcessor.exception_logger
+    def ChunkedTranscode(self, path, mediainfo, codec, crf, speed, options=None):
+        boundaries = self.ChunkBoundaries(path)
+        if len(boundaries) < 2:
+            raise Exception('Only found one chunk in {}'.format(path))
+
+        workers = min(self.config.CHUNK_WORKERS, len(boundaries))
+        threads = max(1, multiprocessing.cpu_count() // workers)
+        logging.info('Encoding {} in {} chunks, {} at a time with {} threads each'.format(path, len(boundaries), workers, threads))
+
+        # Encode just the video of each chunk, with the same deinterlacing and subtitle burn in as a single encode
+        chunk_cmds = []
+        chunk_paths = []
+        for i, start in enumerate(boundaries):
+            chunk_options = dict(options) if options else {}
+            chunk_options.update({'disable_hw_decode' : True, 'video_only' : True, 'threads' : threads,
+                                  'input_seek' : '{:.6f}'.format(start),
+                                  'output_path' : os.path.join(self.temp_dir, 'chunk-%04d.mkv' % i)})
+            if i + 1 < len(boundaries):
+                chunk_options['duration'] = '{:.6f}'.format(boundaries[i + 1] - start)
+            chunk_cmds.extend(self.BuildFFMPEGCommands(path, mediainfo, codec, crf, speed, options=chunk_options))
+            chunk_paths.append(chunk_options['output_path'])
+
+        pool = ThreadPool(workers)
+        try:
+            pool.map(self.Call, chunk_cmds)
+        finally:
+            pool.close()
+
+        # Losslessly join the chunks and bring the audio and subtitles over from the original
+        chunk_list_path = os.path.join(self.temp_dir, 'chunks.txt')
+        with open(chunk_list_path, 'w') as chunk_list:
+            for chunk_path in chunk_paths:
+                chunk_list.write("file '{}'\n".format(chunk_path))
+
+        sub_cmd = []
+        for stream_identifier in self.SubtitleExclusions(mediainfo):
+            sub_cmd.extend(['-map', '-1:s:' + str(stream_identifier)])
+        if len(sub_cmd) > 0:
+            sub_cmd = ['-map', '1:s'] + sub_cmd
+
+        temp_path = os.path.join(self.temp_dir, os.path.splitext(os.path.basename(path))[0] + '.mkv')
+        cmd = ['nice', '-n20', self.config.FFMPEG_PATH, '-y', '-f', 'concat', '-safe', '0', '-i', chunk_list_path, '-i', path,
+               '-map', '0:v', '-map', '1:a'] + sub_cmd + ['-c', 'copy'] + self.MatroskaArgs(temp_path, self.ExpectedDuration(mediainfo, options)) + [temp_path]
+        self.Call(cmd)
+
+        logging.info('Finished processing: {}, transcoded file: {}'.format(path, temp_path))
+        return temp_path
+
+    @MediaProcessor.exception_logger
+    def SubtitleExclusions(self, mediainfo):
+        # Stream IDs of the non-english subtitles we strip out
+        return [track.stream_identifier for track in mediainfo.tracks
+                if track.track_type == "Text" and track.language is not None and track.language != 'en']
+
 class TranscodeScanner(Scanner.MediaScanner):
-    def __init__(self, codec, crf, speed, interactive):
+    JOB_NAME = 'transcode'
+
+    def __init__(self, codec, crf, speed, interactive, probe_workers=1, coordinator=None):
         # Call the super constructor
-        super(TranscodeScanner, self).__init__([self.mpeg2_rule], self.transcode_action, interactive)
+        super(TranscodeScanner, self).__init__([self.mpeg2_rule], self.transcode_action, interactive, probe_workers)
 
         # Save transcoding parameters
         self.codec = codec
@@ -249,25 +492,98 @@ class TranscodeScanner(Scanner.MediaScanner):
         self.speed = speed
 
         # Get the configuration file
-        config_file_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'scripts.conf')
-
-        # Create transcoder object
-        self.transcoder = Transcoder(config_file_path)
+        self.config_file_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'scripts.conf')
+
+        # Hand the encodes out to remote workers instead of running them here
+        self.coordinator = None
+        self.remote_lock = threading.Lock()
+        self.remote_leases = {}
+        if coordinator:
+            self.remote_transcoder = Transcoder(self.config_file_path)
+            self.coordinator = RemoteTranscoder.TranscodeCoordinator(coordinator, self.remote_transcoder.temp_dir, self.remote_complete)
+            self.coordinator.start()
+
+    @property
+    def transcoder(self):
+        # One per thread, so job queue workers never share, or clean up, each other's temp dir
+        if not hasattr(self.local, 'transcoder'):
+            self.local.transcoder = Transcoder(self.config_file_path)
+        return self.local.transcoder
+
+    def job_resource(self):
+        if self.codec in ['hevc_nvenc', 'h264_nvenc'] or \
+                (self.codec == 'auto' and self.config.NVENC_SUPPORT and Capabilities.GetCapabilities(self.config).encoder('hevc_nvenc')):
+            return 'hw_encode'
+        return 'sw_encode'
+
+    def wait(self):
+        # Block until the remote workers have sent everything back. Only once we're done scanning, a watch scans again
+        # for every batch of new recordings and needs the coordinator up for all of them.
+        if self.coordinator is not None:
+            self.coordinator.wait()
+
+    def shutdown(self):
+        if self.coordinator is not None:
+            self.coordinator.shutdown()
+
+    def remote_complete(self, path, output_file, status):
+        # Called on the coordinator as each remote job finishes, so only one overwrite runs at a time
+        with self.remote_lock:
+            lease = self.remote_leases.pop(path, None)
+            try:
+                if status != 0 or output_file is None:
+                    self.remote_transcoder.Error('Remote transcode of {} failed, skipping...'.format(path))
+                elif lease is not None and lease.lost:
+                    self.remote_transcoder.Error('Lost our claim on {} during the remote transcode, skipping...'.format(path))
+                elif self.remote_transcoder.SafeOverwrite(path, output_file) == 0:
+                    # Make sure it ends with .mkv
+                    os.rename(path, os.path.splitext(path)[0] + '.mkv')
+            except Exception, e:
+                self.remote_transcoder.Error('Could not overwrite {} with the remote transcode, skipping...'.format(path))
+            finally:
+                # Other jobs are still landing in the temp dir, so only remove our own file
+                if output_file is not None and os.path.exists(output_file):
+                    os.remove(output_file)
+                if lease is not None:
+                    lease.release()
 
     def transcode_action(self, path, mediainfo):
+        if self.coordinator is not None:
+            # Keep our claim on the file until the remote worker's output has replaced it
+            with self.remote_lock:
+                lease = self.take_lease()
+                if lease is not None:
+                    self.remote_leases[path] = lease
+            self.coordinator.submit(path, self.codec, self.crf, self.speed)
+            return 0
+
         # Transcode the file
         try:
-            output_file = self.transcoder.Transcode(path, self.codec, self.crf, self.speed)
+            output_file = self.transcoder.Transcode(path, self.codec, self.crf, self.speed, mediainfo=mediainfo)
+            if self.lease_lost():
+                self.transcoder.Error('Lost our claim on {} during the transcode, leaving it to the other host...'.format(path))
+                self.transcoder.Cleanup()
+                return 1
             # Safely overwrite the original file
             if self.transcoder.SafeOverwrite(path, output_file) == 0:
                 # Make sure it ends with .mkv
                 os.rename(path, os.path.splitext(path)[0] + '.mkv')
                 # Clean up temporary files
                 self.transcoder.Cleanup()
+                return 0
+            # Encoding it again would only come out the same size
+            return JobQueue.GIVE_UP
+        except MediaProcessor.CommandAborted, e:
+            # Trying again would only end the same way
+            self.transcoder.Error('Gave up transcoding {} early, {}, skipping...'.format(path, e))
+            self.transcoder.Cleanup()
+            return JobQueue.GIVE_UP
         except Exception, e:
             self.transcoder.Error('Could not transcode {}, cleaning up temp files and skipping...'.format(path))
             self.transcoder.Cleanup()
+        return 1
 
+    @Scanner.header_rule('codecs_video')
     def mpeg2_rule(self, mediainfo):
         for track in mediainfo.tracks:
             if track.track_type == "General" and track.codecs_video == 'MPEG-2 Video':
@@ -280,12 +596,22 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--input', action="append", default=[], help='"One or more directories to scan.')
     parser.add_argument("--interactive", action='store_true', help="Be prompted for each file that we want to comskip")
+    parser.add_argument("--watch", action='store_true', help="After the first scan, keep watching the input directories and process new recordings as they settle")
     parser.add_argument("--codec", default='auto', choices=['auto', 'x265', 'hevc_nvenc', 'x264', 'h264_nvenc', 'vp9', 'none'], help="What codec to use for the encoding")
     parser.add_argument("--crf", default='23', choices=map(str, range(0, 51)), help="What quality to use when for encoded (lower is higher quality and bigger files)")
     parser.add_argument("--speed", default='medium', choices=['ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium', 'slow', 'slower', 'veryslow', 'placebo', 'hq'], help="Encoding speed (faster encoding is results in a less efficient representation)")
+    parser.add_argument("--probe-workers", type=int, default=1, help="Number of files to probe with MediaInfo concurrently")
+    parser.add_argument("--coordinator", help="Serve the transcodes to RemoteTranscoder.py workers on this address, host:port or unix:/path")
     args = parser.parse_args()
 
-    transcoder = TranscodeScanner(args.codec, args.crf, args.speed, args.interactive)
-    transcoder.scan(args.input)
+    transcoder = TranscodeScanner(args.codec, args.crf, args.speed, args.interactive, args.probe_workers, args.coordinator)
+    try:
+        if args.watch:
+            transcoder.watch(args.input)
+        else:
+            transcoder.scan(args.input)
+        transcoder.wait()
+    finally:
+        transcoder.shutdown()
 
     sys.exit(0)
@@ -0,0 +1,126 @@
+import ctypes, ctypes.util, logging, os, select, struct, time
+
+# Tell the scanners which files under their input directories were created or changed, so a watching scanner only
+# looks at those instead of walking the whole library. Uses inotify where we can and falls back to comparing
+# directory listings every so often where we can't (no inotify, or out of watches).
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+# struct inotify_event without its trailing name
+EVENT_HEADER = struct.Struct('iIII')
+
+class InotifyWatcher(object):
+    def __init__(self, paths):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.roots = paths
+        self.watches = {}
+        self.found = []
+        try:
+            for path in paths:
+                self.add_tree(path)
+        except OSError:
+            os.close(self.fd)
+            raise
+        # The scan before we start watching already covers what is there now
+        self.found = []
+
+    def add_tree(self, path):
+        # New directories need watches of their own; anything already in them when we get there counts as new too
+        for root, dirs, files in os.walk(path):
+            self.add_watch(root)
+            self.found.extend(os.path.join(root, name) for name in files)
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, path, WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'Could not watch {}'.format(path))
+        self.watches[wd] = path
+
+    def changes(self, timeout):
+        changed = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+
+        data = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip('\0')
+            offset += EVENT_HEADER.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                # We missed events, so look at everything again
+                logging.info('[Watcher] inotify queue overflowed, rescanning')
+                for path in self.roots:
+                    for root, dirs, files in os.walk(path):
+                        changed.update(os.path.join(root, name) for name in files)
+                continue
+
+            if wd not in self.watches or not name:
+                continue
+            path = os.path.join(self.watches[wd], name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    try:
+                        self.add_tree(path)
+                    except OSError, e:
+                        logging.error('[Watcher] {}, changes under it will be missed'.format(e))
+            else:
+                changed.add(path)
+
+        changed.update(self.found)
+        self.found = []
+        return changed
+
+class PollingWatcher(object):
+    def __init__(self, paths, interval):
+        self.paths = paths
+        self.interval = interval
+        self.last_poll = time.time()
+        self.snapshot = self.listing()
+
+    def listing(self):
+        snapshot = {}
+        for path in self.paths:
+            for root, dirs, files in os.walk(path):
+                for name in files:
+                    full_path = os.path.join(root, name)
+                    try:
+                        st = os.stat(full_path)
+                    except OSError:
+                        continue
+                    snapshot[full_path] = (st.st_size, st.st_mtime)
+        return snapshot
+
+    def changes(self, timeout):
+        wait = self.last_poll + self.interval - time.time()
+        if wait > timeout:
+            time.sleep(timeout)
+            return set()
+        time.sleep(max(0, wait))
+
+        self.last_poll = time.time()
+        snapshot = self.listing()
+        changed = set(path for path, key in snapshot.iteritems() if self.snapshot.get(path) != key)
+        self.snapshot = snapshot
+        return changed
+
+def GetWatcher(paths, poll_interval):
+    try:
+        return InotifyWatcher(paths)
+    except (OSError, AttributeError), e:
+        # AttributeError is a libc without inotify
+        logging.info('[Watcher] Could not use inotify ({}), polling every {} seconds instead'.format(e, poll_interval))
+        return PollingWatcher(paths, poll_interval)
@@ -1,44 +1,88 @@
 #!/usr/bin/python
 
-import os, shutil, subprocess, sys, argparse
-import Comskip, Transcoder, ConfigContainer
+import os, shutil, subprocess, sys, argparse, contextlib
+import Capabilities, Comskip, Transcoder, ConfigContainer
+from multiprocessing.pool import ThreadPool
 
 
-def process_file(path, transcode, rename_ext):
+# Stands in for the orchestrator's resource slots when we're the only thing running
+@contextlib.contextmanager
+def no_slot(resource):
+    yield
+
+def process_file(path, transcode, rename_ext, fused=False, pipelined=False, comskip=None, t=None, slot=no_slot):
 
     # Process the configuration file
     config_file_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'scripts.conf')
 
     path = os.path.abspath(path)
 
-    # Create Comskip Object
-    comskip = Comskip.Comskip(config_file_path)
+    # Create Comskip Object, unless the orchestrator gave us the processors to use
+    if comskip is None:
+        comskip = Comskip.Comskip(config_file_path)
+    if transcode and t is None:
+        t = Transcoder.Transcoder(config_file_path)
+    encode_resource = 'hw_encode' if transcode and comskip.config.NVENC_SUPPORT and \
+        Capabilities.GetCapabilities(comskip.config).encoder('hevc_nvenc') else 'sw_encode'
 
-    # Get the segments that are commerical free
-    intermediate_path, segments = comskip.GenerateSegments(path)
+    if transcode and pipelined:
+        # Start transcoding the raw recording while comskip looks for the commercials. The EDL timestamps hold for the
+        # transcoded stream too, so cutting afterwards is just a remux of the much smaller file.
+        def run_transcode():
+            with slot(encode_resource):
+                return t.Transcode(path, 'auto', '23', 'medium', options={'size_bounds' : (.1, 1.2)})
+        pool = ThreadPool(1)
+        transcode_result = pool.apply_async(run_transcode)
+        try:
+            # Get the segments that are commerical free
+            with slot('comskip'):
+                intermediate_path, segments = comskip.GenerateSegments(path)
+        finally:
+            # Even if comskip fell over, don't leave the encode running without us
+            transcode_result.wait()
+            pool.close()
 
-    # Cut the commercials out of the original file
-    processed_file = comskip.ProcessSegments(intermediate_path, segments)
+        with slot('remux'):
+            processed_file = comskip.ConcatCut(transcode_result.get(), segments)
 
-    if transcode:
-        # Transcode into a better format
-        t = Transcoder.Transcoder(config_file_path)
-        # CRF and preset are thrown away when using auto
-        processed_file = t.Transcode(processed_file, 'auto', '23', 'medium')
+    else:
+        # Get the segments that are commerical free
+        with slot('comskip'):
+            intermediate_path, segments = comskip.GenerateSegments(path)
+
+        if transcode and fused:
+            # Cut the commercials out as part of the transcode, so the original is decoded once and the result written once
+            with slot(encode_resource):
+                processed_file = t.Transcode(intermediate_path, 'auto', '23', 'medium', options={'segments' : segments, 'size_bounds' : (.1, 1.2)})
+
+        else:
+            # Cut the commercials out of the original file
+            with slot('remux'):
+                processed_file = comskip.ProcessSegments(intermediate_path, segments)
+
+            if transcode:
+                # Transcode into a better format
+                # CRF and preset are thrown away when using auto
+                with slot(encode_resource):
+                    processed_file = t.Transcode(processed_file, 'auto', '23', 'medium', options={'size_bounds' : (.1, 1.2)})
 
     # Use the processed file extension or not?
     if rename_ext:
-        path = os.path.splitext(path)[0] + os.path.splitext(procesed_file)[1]
+        path = os.path.splitext(path)[0] + os.path.splitext(processed_file)[1]
 
     # Check that file looks sane and then copy it over
-    return comskip.SafeOverwrite(path, processed_file, .1, 1.2)
+    with slot('remux'):
+        return comskip.SafeOverwrite(path, processed_file, .1, 1.2)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--input_file", required = True, help="File to process")
     parser.add_argument("--transcode", action='store_true', help="Transcode the media into a nicer format")
     parser.add_argument("--rename_ext", action='store_true', help="Rename the extension to match the new container")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--fused", action='store_true', help="Cut the commercials out during the transcode instead of in a separate pass")
+    mode.add_argument("--pipelined", action='store_true', help="Transcode while comskip runs, then cut the commercials out of the transcoded file")
     args = parser.parse_args()
 
-    ret = process_file(args.input_file, args.transcode, args.rename_ext)
+    ret = process_file(args.input_file, args.transcode, args.rename_ext, args.fused, args.pipelined)
     sys.exit(ret)
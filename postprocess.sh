@@ -1,9 +1,19 @@
 #!/bin/bash
 
+SCRIPTS=/home/wils/server_configs/plex/scripts
+
 if [[ $1 == *.mkv ]]
 then
     mkvpropedit "$1" --edit track:a1 --set language=eng --edit track:v1 --set language=eng
     echo "Ran MKV Prop Edit"
 fi
 
-python /home/wils/server_configs/plex/scripts/postprocess.py -i "$1" --transcode
+# Hand the recording to the postprocess daemon if it is running, otherwise do the work ourselves
+python $SCRIPTS/postprocess_client.py -i "$1" --transcode
+status=$?
+if [ $status -eq 75 ]
+then
+    python $SCRIPTS/postprocess.py -i "$1" --transcode
+    status=$?
+fi
+exit $status
@@ -0,0 +1,69 @@
+#!/usr/bin/python
+import argparse, json, os, socket, sys
+import ConfigContainer
+
+# Hands a recording to PostprocessDaemon.py and waits for it to be done. Exits with EXIT_NO_DAEMON when the daemon
+# isn't there, so the hook can fall back to running postprocess.py itself.
+EXIT_NO_DAEMON = 75
+
+def SendMessage(wfile, message):
+    wfile.write(json.dumps(message) + '\n')
+    wfile.flush()
+
+def ReadMessage(rfile):
+    line = rfile.readline()
+    if not line:
+        raise socket.error('Connection closed')
+    return json.loads(line)
+
+def submit(socket_path, request):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error, e:
+        print('Could not reach the postprocess daemon at {}: {}'.format(socket_path, e))
+        return EXIT_NO_DAEMON
+
+    try:
+        rfile = sock.makefile('rb')
+        wfile = sock.makefile('wb')
+        SendMessage(wfile, request)
+        while True:
+            reply = ReadMessage(rfile)
+            if 'error' in reply and reply['error'] and 'status' not in reply:
+                print('The postprocess daemon refused the job: {}'.format(reply['error']))
+                return 1
+            if reply.get('queued'):
+                print('Queued {}'.format(request['path']))
+                return 0
+            if 'status' in reply:
+                if reply['error']:
+                    print('Processing {} failed: {}'.format(request['path'], reply['error']))
+                return reply['status'] or 0
+    except socket.error, e:
+        print('Lost the postprocess daemon while it was working on {}: {}'.format(request['path'], e))
+        return 1
+    finally:
+        sock.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input_file", required = True, help="File to process")
+    parser.add_argument("--transcode", action='store_true', help="Transcode the media into a nicer format")
+    parser.add_argument("--rename_ext", action='store_true', help="Rename the extension to match the new container")
+    parser.add_argument("--no-wait", action='store_true', help="Return as soon as the daemon has the job")
+    parser.add_argument("--socket", help="Daemon socket, defaults to socket-path from scripts.conf")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--fused", action='store_true', help="Cut the commercials out during the transcode instead of in a separate pass")
+    mode.add_argument("--pipelined", action='store_true', help="Transcode while comskip runs, then cut the commercials out of the transcoded file")
+    args = parser.parse_args()
+
+    socket_path = args.socket
+    if not socket_path:
+        config_file_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'scripts.conf')
+        socket_path = ConfigContainer.ConfigContainer(config_file_path).DAEMON_SOCKET_PATH
+
+    sys.exit(submit(socket_path, {'op' : 'submit', 'path' : os.path.abspath(args.input_file), 'transcode' : args.transcode,
+                                  'rename_ext' : args.rename_ext, 'fused' : args.fused, 'pipelined' : args.pipelined,
+                                  'wait' : not args.no_wait}))